@@ -0,0 +1,251 @@
+'''
+Name: bench_pipeline.py
+
+Version: 1.0
+
+Summary: Benchmark the stages and the full pipeline of smart_release.py on the sample images and on upscaled synthetic images,
+    record throughput, latency percentiles and peak memory, and compare them against a stored baseline
+
+USAGE:
+
+    python3 benchmarks/bench_pipeline.py
+
+    python3 benchmarks/bench_pipeline.py -mp 4,12 -r 5 -st color_cluster_seg,pipeline
+
+    python3 benchmarks/bench_pipeline.py -sb 1
+
+    python3 benchmarks/bench_pipeline.py -t 0.1 -mt 0.1 -o result.json
+
+'''
+
+import os
+import sys
+import glob
+import json
+import shutil
+import tempfile
+import time
+import argparse
+
+from collections import OrderedDict
+
+import numpy as np
+import cv2
+
+
+# root folder of the repository
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, REPO_PATH)
+
+import smart_release as sr
+
+
+# benchmarked pipeline stages, the full pipeline is benchmarked as 'pipeline'
+BENCH_STAGES = ['color_cluster_seg', 'color_region', 'comp_external_contour', 'skeleton_bw', 'watershed_seg', 'pipeline']
+
+
+# load the sample images, the alpha channel of plant region images is dropped
+def load_images(pattern):
+
+    images = OrderedDict()
+
+    for image_file in sorted(glob.glob(os.path.join(REPO_PATH, pattern), recursive = True)):
+
+        image = cv2.imread(image_file, cv2.IMREAD_COLOR)
+
+        if image is not None:
+            images[os.path.splitext(os.path.basename(image_file))[0]] = image
+
+    return images
+
+
+# upscale the image to the number of megapixels, the aspect ratio is kept
+def synthetic_image(image, megapixels):
+
+    (img_height, img_width) = image.shape[:2]
+
+    scale = np.sqrt(megapixels * 1e6 / (img_height * img_width))
+
+    return cv2.resize(image, (int(round(img_width * scale)), int(round(img_height * scale))), interpolation = cv2.INTER_LINEAR)
+
+
+# run the function repeatedly, return the latencies in seconds and the peak resident memory in MB
+def measure(function, repeats):
+
+    latencies = []
+
+    sr.peak_rss_reset()
+
+    for i in range(repeats):
+
+        start = time.perf_counter()
+
+        function()
+
+        latencies.append(time.perf_counter() - start)
+
+    return latencies, sr.peak_rss_mb()
+
+
+# benchmark the selected stages on one image with the configuration of the pipeline,
+# the stages after the segmentation run on the plant ROI if enabled, return one result per stage
+def bench_image(image, image_file, result_path, stages, repeats):
+    from scipy import ndimage
+
+    args = sr.args
+
+    # inputs of the stages which follow the segmentation
+    thresh = sr.color_cluster_seg(image, args['color_space'], args['channels'], 2, args['seg_engine'], args['sample_size'], args['seed'], args['seg_scale'])
+
+    roi_box = sr.plant_roi(thresh, args['min_dist'] + 2) if args['roi'] == 1 else None
+
+    (thresh_combined, trait_img, area, solidity, max_width, max_height, longest_dimension) = sr.comp_external_contour(image.copy(), thresh.copy())
+
+    image_roi = sr.roi_crop(image, roi_box)
+
+    thresh_roi = sr.roi_crop(thresh_combined, roi_box)
+
+    # distance transform shared by the watershed and the medial axis skeleton, computed once as in the pipeline
+    distance = ndimage.distance_transform_edt(thresh_roi)
+
+    calls = {'color_cluster_seg': lambda: sr.color_cluster_seg(image, args['color_space'], args['channels'], 2, args['seg_engine'], args['sample_size'], args['seed'], args['seg_scale']),
+             'color_region': lambda: sr.color_region(image, thresh.copy(), result_path, args['num_clusters'], args['seed'], False, roi_box),
+             'comp_external_contour': lambda: sr.comp_external_contour(image.copy(), thresh.copy()),
+             'skeleton_bw': lambda: sr.skeleton_bw(thresh_roi, args['skeleton_engine'], distance),
+             'watershed_seg': lambda: sr.watershed_seg(image_roi, thresh_roi, args['min_dist'], distance),
+             'pipeline': lambda: sr.extract_traits(image_file, result_path)}
+
+    megapixels = image.shape[0] * image.shape[1] / 1e6
+
+    results = OrderedDict()
+
+    for stage in stages:
+
+        (latencies, peak_rss) = measure(calls[stage], repeats)
+
+        results[stage] = {'megapixels': megapixels,
+                          'p50_s': float(np.percentile(latencies, 50)), 'p90_s': float(np.percentile(latencies, 90)), 'p99_s': float(np.percentile(latencies, 99)),
+                          'throughput_mp_s': megapixels / float(np.median(latencies)),
+                          'peak_rss_mb': peak_rss}
+
+        print("{:<24} {:>6.1f} MP  p50 = {:.3f} s  p90 = {:.3f} s  {:.2f} MP/s  peak = {:.0f} MB".format(stage, megapixels, results[stage]['p50_s'], results[stage]['p90_s'],
+                                                                                                      results[stage]['throughput_mp_s'], peak_rss))
+
+    return results
+
+
+# compare the results against the baseline, return the list of regressions
+def compare_baseline(results, baseline, tolerance, memory_tolerance):
+
+    regressions = []
+
+    for key, result in results.items():
+
+        if key not in baseline:
+            continue
+
+        reference = baseline[key]
+
+        if result['p50_s'] > reference['p50_s'] * (1 + tolerance):
+            regressions.append("{}: p50 latency {:.3f} s, baseline {:.3f} s".format(key, result['p50_s'], reference['p50_s']))
+
+        if result['peak_rss_mb'] > reference['peak_rss_mb'] * (1 + memory_tolerance):
+            regressions.append("{}: peak memory {:.0f} MB, baseline {:.0f} MB".format(key, result['peak_rss_mb'], reference['peak_rss_mb']))
+
+    return regressions
+
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--images", dest = "images", type = str, required = False, default = 'sample_test/**/*_plant_region.png', help = "glob pattern of the sample images, relative to the repository folder")
+    ap.add_argument("-mp", "--megapixels", dest = "megapixels", type = str, required = False, default = '4,12,24', help = "comma separated sizes of the upscaled synthetic images in megapixels")
+    ap.add_argument("-st", "--stages", dest = "stages", type = str, required = False, default = ','.join(BENCH_STAGES), help = "comma separated stages to benchmark: " + ", ".join(BENCH_STAGES))
+    ap.add_argument("-r", "--repeats", dest = "repeats", type = int, required = False, default = 3, help = "number of runs of each stage")
+    ap.add_argument("-b", "--baseline", dest = "baseline", type = str, required = False, default = os.path.join(REPO_PATH, 'benchmarks', 'baseline.json'), help = "baseline result file")
+    ap.add_argument("-sb", "--save_baseline", dest = "save_baseline", type = int, required = False, default = 0, help = "save the results as the new baseline, 1 = yes, 0 = no")
+    ap.add_argument("-t", "--tolerance", dest = "tolerance", type = float, required = False, default = 0.25, help = "allowed relative increase of the p50 latency")
+    ap.add_argument("-mt", "--memory_tolerance", dest = "memory_tolerance", type = float, required = False, default = 0.25, help = "allowed relative increase of the peak memory")
+    ap.add_argument("-o", "--output", dest = "output", type = str, required = False, default = None, help = "save the results to this json file")
+    bench_args = vars(ap.parse_args())
+
+    stages = [stage.strip() for stage in bench_args['stages'].split(',') if stage.strip()]
+
+    unknown = set(stages) - set(BENCH_STAGES)
+
+    if unknown:
+        ap.error("Unknown stages {}, choose from: {}".format(', '.join(sorted(unknown)), ', '.join(BENCH_STAGES)))
+
+    images = load_images(bench_args['images'])
+
+    if not images:
+        print("No sample image matches {}\n".format(bench_args['images']))
+        sys.exit(1)
+
+    work_path = tempfile.mkdtemp(prefix = 'smart_bench_')
+
+    # default pipeline parameters without the AI model, result cache and debug images
+    sr.set_parameters(vars(sr.build_arg_parser().parse_args(['-p', work_path, '-ai', '0', '-d', '0', '-cache', '0'])))
+
+    results = OrderedDict()
+
+    try:
+        for (name, image) in images.items():
+
+            sizes = [('native', image)] + [("{}mp".format(mp), synthetic_image(image, float(mp))) for mp in bench_args['megapixels'].split(',') if mp.strip()]
+
+            for (size, sized_image) in sizes:
+
+                image_file = os.path.join(work_path, "{}_{}.png".format(name, size))
+
+                cv2.imwrite(image_file, sized_image)
+
+                result_path = os.path.join(work_path, "{}_{}".format(name, size), '')
+
+                os.makedirs(result_path, exist_ok = True)
+
+                print("\nImage {} at {} resolution, {} X {}\n".format(name, size, sized_image.shape[1], sized_image.shape[0]))
+
+                for (stage, result) in bench_image(sized_image, image_file, result_path, stages, bench_args['repeats']).items():
+                    results["{}@{}/{}".format(stage, name, size)] = result
+
+    finally:
+        shutil.rmtree(work_path, ignore_errors = True)
+
+    if bench_args['output']:
+
+        with open(bench_args['output'], 'w') as f:
+            json.dump(results, f, indent = 2)
+
+    if bench_args['save_baseline'] == 1:
+
+        with open(bench_args['baseline'], 'w') as f:
+            json.dump(results, f, indent = 2)
+
+        print("\nBaseline was saved at {}\n".format(bench_args['baseline']))
+
+        sys.exit(0)
+
+    if not os.path.isfile(bench_args['baseline']):
+
+        print("\nNo baseline at {}, save one with -sb 1\n".format(bench_args['baseline']))
+
+        sys.exit(0)
+
+    with open(bench_args['baseline']) as f:
+        baseline = json.load(f)
+
+    regressions = compare_baseline(results, baseline, bench_args['tolerance'], bench_args['memory_tolerance'])
+
+    if regressions:
+
+        print("\n{} regressions against the baseline:\n".format(len(regressions)))
+
+        for regression in regressions:
+            print("    " + regression)
+
+        sys.exit(1)
+
+    print("\nNo regression against the baseline\n")
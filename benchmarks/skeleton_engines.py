@@ -0,0 +1,147 @@
+'''
+Name: skeleton_engines.py
+
+Version: 1.0
+
+Summary: Compare the skeleton engines of skeleton_bw in smart_release.py with skimage thin on the sample masks,
+    check that guo_hall and auto give the same skeleton as thin and that the other engines keep the connected components of thin,
+    record the run time of each engine
+
+USAGE:
+
+    python3 benchmarks/skeleton_engines.py
+
+    python3 benchmarks/skeleton_engines.py -sc 0.5 -r 3
+
+    python3 benchmarks/skeleton_engines.py -m "/path/to/results/*_mask.png" -e thin,guo_hall
+
+'''
+
+import os
+import sys
+import glob
+import time
+import argparse
+
+import numpy as np
+import cv2
+
+from scipy import ndimage
+
+
+# root folder of the repository
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, REPO_PATH)
+
+import smart_release as sr
+
+
+# engines which must give exactly the skeleton of thin
+EXACT_ENGINES = ['auto', 'guo_hall']
+
+
+# number of 8-connected components of a binary image
+def count_components(image):
+
+    return ndimage.label(image, structure = np.ones((3, 3)))[1]
+
+
+# run the engine repeatedly, return the skeleton and the median run time in seconds
+def run_engine(mask, engine, repeats):
+
+    times = []
+
+    for i in range(repeats):
+
+        start = time.perf_counter()
+
+        (skeleton_img, skeleton) = sr.skeleton_bw(mask, engine)
+
+        times.append(time.perf_counter() - start)
+
+    return skeleton, float(np.median(times))
+
+
+# compare the skeleton of one engine with the skeleton of thin, return the list of failed checks
+def compare_skeleton(engine, skeleton, reference, mask):
+
+    failures = []
+
+    if engine in EXACT_ENGINES and not np.array_equal(skeleton, reference):
+        failures.append("{}: {} pixels differ from thin".format(engine, int(np.count_nonzero(skeleton != reference))))
+
+    if np.any(skeleton & (mask == 0)):
+        failures.append("{}: skeleton pixels outside of the mask".format(engine))
+
+    if count_components(skeleton) != count_components(reference):
+        failures.append("{}: {} connected components, thin has {}".format(engine, count_components(skeleton), count_components(reference)))
+
+    return failures
+
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-m", "--masks", dest = "masks", type = str, required = False, default = 'sample_test/**/*_mask.png', help = "glob pattern of the mask images, relative to the repository folder")
+    ap.add_argument("-e", "--engines", dest = "engines", type = str, required = False, default = ','.join(sr.SKELETON_ENGINES), help = "comma separated skeleton engines: " + ", ".join(sr.SKELETON_ENGINES))
+    ap.add_argument("-sc", "--scale", dest = "scale", type = float, required = False, default = 1.0, help = "scale factor of the masks, < 1 shortens the run time of thin")
+    ap.add_argument("-r", "--repeats", dest = "repeats", type = int, required = False, default = 1, help = "number of runs of each engine")
+    bench_args = vars(ap.parse_args())
+
+    engines = [engine.strip() for engine in bench_args['engines'].split(',') if engine.strip() and engine.strip() != 'thin']
+
+    mask_files = sorted(glob.glob(os.path.join(REPO_PATH, bench_args['masks']), recursive = True))
+
+    if not mask_files:
+        print("No mask image matches {}\n".format(bench_args['masks']))
+        sys.exit(1)
+
+    # compile the numba kernels before timing
+    warm_up = np.zeros((16, 16), dtype = np.uint8)
+    warm_up[4:12, 4:12] = 255
+
+    for engine in engines:
+        sr.skeleton_bw(warm_up, engine)
+
+    failures = []
+
+    for mask_file in mask_files:
+
+        mask = cv2.imread(mask_file, cv2.IMREAD_GRAYSCALE)
+
+        if bench_args['scale'] != 1.0:
+            mask = cv2.resize(mask, None, fx = bench_args['scale'], fy = bench_args['scale'], interpolation = cv2.INTER_NEAREST)
+
+        mask = np.where(mask > 127, 255, 0).astype(np.uint8)
+
+        print("\nMask {}, {} X {}, {} foreground pixels\n".format(os.path.basename(mask_file), mask.shape[1], mask.shape[0], np.count_nonzero(mask)))
+
+        (reference, reference_time) = run_engine(mask, 'thin', bench_args['repeats'])
+
+        print("{:<14} {:>8.3f} s  {:>8d} pixels".format('thin', reference_time, int(np.count_nonzero(reference))))
+
+        # distance of every pixel to the skeleton of thin
+        reference_distance = ndimage.distance_transform_edt(~reference)
+
+        for engine in engines:
+
+            (skeleton, engine_time) = run_engine(mask, engine, bench_args['repeats'])
+
+            print("{:<14} {:>8.3f} s  {:>8d} pixels  speed up {:>6.1f} X  mean distance to thin {:.2f} px".format(engine, engine_time, int(np.count_nonzero(skeleton)),
+                                                                                                                reference_time / max(engine_time, 1e-9),
+                                                                                                                float(reference_distance[skeleton].mean()) if np.any(skeleton) else 0.0))
+
+            failures += ["{}: {}".format(os.path.basename(mask_file), failure) for failure in compare_skeleton(engine, skeleton, reference, mask)]
+
+    if failures:
+
+        print("\n{} failed checks:\n".format(len(failures)))
+
+        for failure in failures:
+            print("    " + failure)
+
+        sys.exit(1)
+
+    print("\nAll skeleton engines passed the checks against thin\n")
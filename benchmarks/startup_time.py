@@ -0,0 +1,74 @@
+'''
+Name: startup_time.py
+
+Version: 1.0
+
+Summary: Measure the start up time of smart_release.py and list the heavy packages which were imported at start up
+
+USAGE:
+
+    python3 benchmarks/startup_time.py
+
+    python3 benchmarks/startup_time.py -r 10
+
+'''
+
+import os
+import sys
+import subprocess
+import time
+import argparse
+
+import numpy as np
+
+
+# root folder of the repository
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# packages which should only be imported by the code paths using them
+HEAVY_PACKAGES = ['sklearn', 'skimage', 'scipy', 'matplotlib', 'openpyxl', 'rembg', 'onnxruntime', 'pyarrow', 'numba']
+
+
+# time one python command in a fresh interpreter, return the wall time in seconds
+def time_command(command):
+
+    start = time.perf_counter()
+
+    subprocess.run(command, cwd = REPO_PATH, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, check = True)
+
+    return time.perf_counter() - start
+
+
+# list the heavy packages loaded by importing smart_release
+def loaded_heavy_packages():
+
+    code = "import sys, smart_release; print(','.join(sorted({name.split('.')[0] for name in sys.modules})))"
+
+    output = subprocess.run([sys.executable, '-c', code], cwd = REPO_PATH, capture_output = True, text = True, check = True).stdout
+
+    loaded = set(output.strip().split(','))
+
+    return [name for name in HEAVY_PACKAGES if name in loaded]
+
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-r", "--repeats", dest = "repeats", type = int, required = False, default = 5, help = "number of runs of each command")
+    args = vars(ap.parse_args())
+
+    commands = [('python baseline', [sys.executable, '-c', 'pass']),
+                ('import smart_release', [sys.executable, '-c', 'import smart_release']),
+                ('smart_release.py --help', [sys.executable, 'smart_release.py', '--help'])]
+
+    for (name, command) in commands:
+
+        # the first run warms up the file system cache
+        time_command(command)
+
+        times = [time_command(command) for i in range(args['repeats'])]
+
+        print("{:<28} median = {:.3f} s, min = {:.3f} s\n".format(name, np.median(times), np.min(times)))
+
+    print("Heavy packages imported at start up: {}\n".format(', '.join(loaded_heavy_packages()) or 'none'))
@@ -0,0 +1,68 @@
+"""
+Version: 1.0
+Summary: batched color conversion and color difference of cluster colors, designed for the per image color traits of smart_release.py
+
+USAGE
+
+import color_metrics
+# using as a library
+
+lab = color_metrics.rgb_to_lab(rgb_colors)
+
+diff = color_metrics.delta_e_matrix(lab, color_metrics.rgb_to_lab([(157, 188, 64)]), method = 'ciede2000')
+
+"""
+#!/usr/bin/python
+
+
+# import the necessary packages, scikit-image is only imported by the functions using it to keep the start up fast
+import numpy as np
+
+
+# color difference formulas supported by delta_e_matrix
+DELTA_E_METHODS = ['cie76', 'ciede2000']
+
+
+# convert RGB colors to CIE Lab in one call, uint8 colors of any shape (..., 3), e.g. a list of cluster centers, return float array of shape (N, 3)
+# skimage Lab ranges: L (0 ~ 100), a and b (-128 ~ 127)
+def rgb_to_lab(rgb_colors):
+    from skimage.color import rgb2lab
+
+    rgb = np.asarray(rgb_colors, dtype = np.float64).reshape((-1, 3)) / 255.0
+
+    return rgb2lab(rgb)
+
+
+# skimage Lab to OpenCV 8-bit Lab scale (0 ~ 255): L <- L*255/100, a <- a + 128, b <- b + 128
+def lab_to_opencv(lab):
+
+    lab = np.asarray(lab, dtype = np.float64)
+
+    return np.stack([lab[..., 0]*255/100.0, lab[..., 1] + 128.0, lab[..., 2] + 128.0], axis = -1)
+
+
+# OpenCV 8-bit Lab scale (0 ~ 255) to skimage Lab
+def opencv_to_lab(lab):
+
+    lab = np.asarray(lab, dtype = np.float64)
+
+    return np.stack([lab[..., 0]*100/255.0, lab[..., 1] - 128.0, lab[..., 2] - 128.0], axis = -1)
+
+
+# color difference between every color and every reference color, both given in the same Lab scale,
+# return matrix of shape (number of colors, number of reference colors)
+def delta_e_matrix(lab_colors, ref_lab_colors, method = 'cie76'):
+
+    lab_colors = np.asarray(lab_colors, dtype = np.float64).reshape((-1, 1, 3))
+
+    ref_lab_colors = np.asarray(ref_lab_colors, dtype = np.float64).reshape((1, -1, 3))
+
+    if method == 'cie76':
+        return np.sqrt(((lab_colors - ref_lab_colors)**2).sum(axis = 2))
+
+    elif method == 'ciede2000':
+        from skimage.color import deltaE_ciede2000
+
+        return deltaE_ciede2000(*np.broadcast_arrays(lab_colors, ref_lab_colors))
+
+    raise ValueError("Unknown color difference method {}, choose from: {}".format(method, ', '.join(DELTA_E_METHODS)))
@@ -1123,6 +1123,11 @@ def leaf_traits_computation(orig, labels, save_path, base_name, file_extension):
     num_clusters = 5
     
 
+    (img_height, img_width) = labels.shape[:2]
+    
+    # bounding box of every label region, found in one pass over the label image
+    label_slices = ndimage.find_objects(labels)
+
     # curvature computation
     # loop over the unique labels returned by the Watershed algorithm
     for index, label in enumerate(np.unique(labels), start = 1):
@@ -1130,11 +1135,21 @@ def leaf_traits_computation(orig, labels, save_path, base_name, file_extension):
         # so simply ignore it
         if label == 0:
             continue
+        
+        # bounding box of the label region, with one pixel margin so the crop border does not touch the leaf
+        (slice_y, slice_x) = label_slices[label - 1]
+        
+        y_start = max(slice_y.start - 1, 0)
+        y_end = min(slice_y.stop + 1, img_height)
+        x_start = max(slice_x.start - 1, 0)
+        x_end = min(slice_x.stop + 1, img_width)
      
         # otherwise, allocate memory for the label region and draw
-        # it on the mask
-        mask = np.zeros(gray.shape, dtype = "uint8")
-        mask[labels == label] = 255
+        # it on the mask, only inside the bounding box of the label
+        mask = np.zeros((y_end - y_start, x_end - x_start), dtype = "uint8")
+        mask[labels[y_start:y_end, x_start:x_end] == label] = 255
+        
+        orig_crop = orig[y_start:y_end, x_start:x_end]
         
         
         #get the medial axis of the contour
@@ -1142,7 +1157,7 @@ def leaf_traits_computation(orig, labels, save_path, base_name, file_extension):
 
                 
         # apply individual object mask
-        masked = cv2.bitwise_and(orig, orig, mask = mask)
+        masked = cv2.bitwise_and(orig_crop, orig_crop, mask = mask)
         
         #individual leaf segmentation and color analysis
         ################################################################################
@@ -1162,7 +1177,7 @@ def leaf_traits_computation(orig, labels, save_path, base_name, file_extension):
         
         #save color quantization result
         #rgb_colors = color_quantization(image, thresh, save_path, num_clusters)
-        (rgb_colors, counts, hex_colors) = color_region(masked, mask, save_path_leaf, num_clusters)
+        (rgb_colors, counts, hex_colors, color_ratio) = color_region(masked, mask, save_path_leaf, num_clusters)
         
         #print("hex_colors = {} {}\n".format(hex_colors, type(hex_colors)))
         
@@ -1190,7 +1205,8 @@ def leaf_traits_computation(orig, labels, save_path, base_name, file_extension):
         
         # detect contours in the mask and grab the largest one
         #cnts = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
-        contours, hierarchy = cv2.findContours(mask.copy(),cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        # contour coordinates are shifted back to the full image frame
+        contours, hierarchy = cv2.findContours(mask.copy(),cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE, offset = (x_start, y_start))
         c = max(contours, key = cv2.contourArea)
         
        
@@ -13,20 +13,21 @@ import utils
 #!/usr/bin/python
 
 
-# import the necessary packages
+# import the necessary packages, matplotlib is only imported by the functions using it to keep the start up fast
 import numpy as np
 import cv2
-from scipy import ndimage
-import pylab as P
-from matplotlib import pyplot as plt
-import matplotlib.colors as colors
-from matplotlib.ticker import FormatStrFormatter
 
 
 # Function of rgb to hex color space
 def rgb_to_hex(rgb_tuple):
+    import matplotlib.colors as colors
     return colors.rgb2hex([1.0*x/255 for x in rgb_tuple])
 
+# Function of hex color string to BGR tuple for OpenCV drawing
+def hex_to_bgr(hex_color):
+    hex_color = hex_color.lstrip('#')
+    return tuple(int(hex_color[i:i+2], 16) for i in (4, 2, 0))
+
 # Function for generating the histogram using centered labels
 def centroid_histogram(clt):
     # grab the number of different clusters and create a histogram 
@@ -43,6 +44,9 @@ def centroid_histogram(clt):
     
 # Function for plotting the histogram using centered labels    
 def plot_centroid_histogram(path, clt):
+    from matplotlib import pyplot as plt
+    from matplotlib.ticker import FormatStrFormatter
+    
     # grab the number of different clusters and create a histogram
     # based on the number of pixels assigned to each cluster
     numLabels = np.arange(0, len(np.unique(clt.labels_)) + 1)
@@ -159,6 +163,9 @@ def plot_colors(hist, centroids):
 
 # Function for plotting the histogram using centered labels    
 def plot_labeled_histogram(pixels,bins_num):
+    from matplotlib import pyplot as plt
+    from matplotlib.ticker import FormatStrFormatter
+    
     # grab the number of different clusters and create a histogram
     # based on the number of pixels assigned to each cluster
     numLabels = bins_num
@@ -210,21 +217,78 @@ def plot_labeled_histogram(pixels,bins_num):
     return numLabels
     
 
-def plot_color_bar(path, bar):
+# Function for drawing a pie chart into an image with OpenCV, wedges start at 3 o'clock and go counterclockwise like matplotlib
+def draw_pie_chart(values, labels, hex_colors, width = 800, height = 600):
     
-    #show color bart and save bar figure
-    fig = plt.figure(0)
-    plt.title("Color Distributation Histogram")
-    plt.imshow(bar)
-    plt.xlabel("Percentage")
-    plt.ylabel("Color category")
-    frame = plt.gca()
-    #frame.axes.get_xaxis().set_visible(False)
-    frame.axes.get_yaxis().set_visible(False)
+    canvas = np.full((height, width, 3), 255, dtype = np.uint8)
+    
+    values = np.asarray(list(values), dtype = float)
+    
+    if values.sum() <= 0:
+        return canvas
+    
+    center = (width // 2, height // 2)
+    radius = int(min(width, height) * 0.3)
+    
+    angles = np.concatenate(([0.0], np.cumsum(values) / values.sum() * 360.0))
+    
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    
+    for (start, end, label, hex_color) in zip(angles[:-1], angles[1:], labels, hex_colors):
+        
+        # angles of OpenCV are clockwise since the y axis points down
+        cv2.ellipse(canvas, center, (radius, radius), 0, -end, -start, hex_to_bgr(hex_color), -1, cv2.LINE_AA)
+        
+        # label outside the middle of the wedge, right aligned on the left half
+        mid = np.deg2rad((start + end) / 2.0)
+        
+        x = center[0] + 1.1 * radius * np.cos(mid)
+        y = center[1] - 1.1 * radius * np.sin(mid)
+        
+        ((text_width, text_height), baseline) = cv2.getTextSize(str(label), font, 0.5, 1)
+        
+        if np.cos(mid) < 0:
+            x -= text_width
+        
+        cv2.putText(canvas, str(label), (int(x), int(y + text_height / 2)), font, 0.5, (0, 0, 0), 1, cv2.LINE_AA)
+    
+    return canvas
 
+
+# Function for drawing the color bar with a percentage axis into an image with OpenCV
+def draw_color_bar(bar, width = 600, bar_height = 60, margin = 40):
+    
+    canvas = np.full((bar_height + 3 * margin, width + 2 * margin, 3), 255, dtype = np.uint8)
+    
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    
+    cv2.putText(canvas, "Color Distributation Histogram", (margin, int(margin * 0.7)), font, 0.6, (0, 0, 0), 1, cv2.LINE_AA)
+    
+    # bar is in RGB order, scale up without blending the color blocks
+    canvas[margin:margin + bar_height, margin:margin + width] = cv2.resize(cv2.cvtColor(bar, cv2.COLOR_RGB2BGR), (width, bar_height), interpolation = cv2.INTER_NEAREST)
+    
+    # percentage ticks
+    for percent in range(0, 101, 20):
+        
+        x = margin + int(round(percent * (width - 1) / 100.0))
+        
+        cv2.line(canvas, (x, margin + bar_height), (x, margin + bar_height + 5), (0, 0, 0), 1)
+        
+        ((text_width, text_height), baseline) = cv2.getTextSize(str(percent), font, 0.4, 1)
+        
+        cv2.putText(canvas, str(percent), (x - text_width // 2, margin + bar_height + 8 + text_height), font, 0.4, (0, 0, 0), 1, cv2.LINE_AA)
+    
+    ((text_width, text_height), baseline) = cv2.getTextSize("Percentage", font, 0.5, 1)
+    
+    cv2.putText(canvas, "Percentage", (margin + (width - text_width) // 2, canvas.shape[0] - 8), font, 0.5, (0, 0, 0), 1, cv2.LINE_AA)
+    
+    return canvas
+
+
+def plot_color_bar(path, bar):
+    
     #save bar image
-    complete_path = path + 'color_bar.png'       
-    plt.savefig(complete_path)
-    plt.close(fig)
+    complete_path = path + 'color_bar.png'
+    cv2.imwrite(complete_path, draw_color_bar(bar))
 
     
@@ -0,0 +1,243 @@
+"""
+Version: 1.0
+Summary: numba kernels of the skeleton engines of smart_release.py, lookup table thinning (Guo-Hall, Zhang-Suen) and medial axis from a distance transform
+
+USAGE
+
+import skeleton_kernels
+# using as a library, requires numba
+
+skeleton = skeleton_kernels.guo_hall_thinning(mask)
+
+skeleton = skeleton_kernels.zhang_suen_thinning(mask)
+
+skeleton = skeleton_kernels.medial_axis_skeleton(mask, distance)
+
+"""
+#!/usr/bin/python
+
+
+# import the necessary packages
+import numpy as np
+import numba
+
+
+# the 8 neighbors of a pixel are coded as bits of one byte, counter clockwise from the right neighbor:
+#   8   4   2
+#  16   p   1
+#  32  64 128
+NEIGHBOR_OFFSETS = np.array([(0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1), (1, 0), (1, 1)], dtype = np.int64)
+
+
+# bits of the neighborhood code
+def neighbor_bits(code):
+    return [bool(code >> i & 1) for i in range(8)]
+
+
+# deletion lookup tables of the two subiterations of Guo and Hall (1989), algorithm A1, the same tables as skimage.morphology.thin
+def guo_hall_luts():
+
+    g1 = np.zeros(256, dtype = bool)
+    g2 = np.zeros(256, dtype = bool)
+    g3 = np.zeros(256, dtype = bool)
+    g3p = np.zeros(256, dtype = bool)
+
+    for code in range(256):
+
+        bits = neighbor_bits(code)
+
+        g1[code] = sum(1 for i in (0, 2, 4, 6) if not bits[i] and (bits[i + 1] or bits[(i + 2) % 8])) == 1
+
+        n1 = sum(1 for k in (1, 3, 5, 7) if bits[k] or bits[k - 1])
+        n2 = sum(1 for k in (1, 3, 5, 7) if bits[k] or bits[(k + 1) % 8])
+
+        g2[code] = min(n1, n2) in (2, 3)
+
+        g3[code] = not ((bits[1] or bits[2] or not bits[7]) and bits[0])
+        g3p[code] = not ((bits[5] or bits[6] or not bits[3]) and bits[4])
+
+    return (g1 & g2 & g3).astype(np.uint8), (g1 & g2 & g3p).astype(np.uint8)
+
+
+# deletion lookup tables of the two subiterations of Zhang and Suen (1984)
+def zhang_suen_luts():
+
+    lut1 = np.zeros(256, dtype = np.uint8)
+    lut2 = np.zeros(256, dtype = np.uint8)
+
+    for code in range(256):
+
+        bits = neighbor_bits(code)
+
+        # P2 ... P9 clockwise from the top neighbor
+        (p2, p3, p4, p5, p6, p7, p8, p9) = (bits[2], bits[1], bits[0], bits[7], bits[6], bits[5], bits[4], bits[3])
+
+        sequence = [p2, p3, p4, p5, p6, p7, p8, p9, p2]
+
+        # number of 0 -> 1 transitions and number of foreground neighbors
+        transitions = sum(1 for i in range(8) if not sequence[i] and sequence[i + 1])
+
+        n_neighbors = sum(bits)
+
+        common = 2 <= n_neighbors <= 6 and transitions == 1
+
+        lut1[code] = common and not (p2 and p4 and p6) and not (p4 and p6 and p8)
+        lut2[code] = common and not (p2 and p4 and p8) and not (p2 and p6 and p8)
+
+    return lut1, lut2
+
+
+# keep table of the medial axis: a pixel is kept if removing it changes the 8-connectivity of its 3 x 3 neighborhood
+# or if it has less than 2 neighbors, the 9 bit index codes the neighborhood row by row with the pixel at bit 4, as skimage.morphology.medial_axis
+def medial_axis_table():
+    from scipy import ndimage
+
+    def pattern(index):
+        return np.array([[index >> (3*row + col) & 1 for col in range(3)] for row in range(3)], dtype = bool)
+
+    eight_connect = np.ones((3, 3), dtype = bool)
+
+    table = np.zeros(512, dtype = np.uint8)
+
+    for index in range(512):
+
+        if index & 16:
+
+            bridge = ndimage.label(pattern(index), eight_connect)[1] != ndimage.label(pattern(index & ~16), eight_connect)[1]
+
+            table[index] = bridge or pattern(index).sum() < 3
+
+    return table
+
+
+# parallel thinning with two subiterations, the pixels whose neighborhood code is marked in the lookup table of the subiteration are deleted at once,
+# repeated until no pixel changes, only the remaining foreground pixels are visited
+@numba.njit(cache = True)
+def lut_thinning(image, lut1, lut2):
+
+    (height, width) = image.shape
+
+    (rows, cols) = np.nonzero(image)
+
+    n_points = rows.shape[0]
+
+    delete = np.zeros(n_points, dtype = np.bool_)
+
+    changed = True
+
+    while changed:
+
+        changed = False
+
+        for subiteration in range(2):
+
+            lut = lut1 if subiteration == 0 else lut2
+
+            # deletion decisions are taken on the image of the previous subiteration
+            for k in range(n_points):
+
+                (r, c) = (rows[k], cols[k])
+
+                code = 0
+
+                for bit in range(8):
+
+                    (rr, cc) = (r + NEIGHBOR_OFFSETS[bit, 0], c + NEIGHBOR_OFFSETS[bit, 1])
+
+                    if rr >= 0 and rr < height and cc >= 0 and cc < width and image[rr, cc]:
+                        code |= 1 << bit
+
+                delete[k] = lut[code] == 1
+
+            # delete the marked pixels and compact the list of foreground pixels
+            kept = 0
+
+            for k in range(n_points):
+
+                if delete[k]:
+                    image[rows[k], cols[k]] = 0
+                    changed = True
+                else:
+                    rows[kept] = rows[k]
+                    cols[kept] = cols[k]
+                    kept += 1
+
+            n_points = kept
+
+    return image
+
+
+# sequential removal of the pixels in the given order, a pixel is kept if its neighborhood is marked in the keep table
+@numba.njit(cache = True)
+def ordered_removal(image, rows, cols, order, table):
+
+    (height, width) = image.shape
+
+    for k in order:
+
+        (r, c) = (rows[k], cols[k])
+
+        index = 0
+
+        for dr in range(-1, 2):
+            for dc in range(-1, 2):
+
+                (rr, cc) = (r + dr, c + dc)
+
+                if rr >= 0 and rr < height and cc >= 0 and cc < width and image[rr, cc]:
+                    index |= 1 << (3*(dr + 1) + dc + 1)
+
+        if table[index] == 0:
+            image[r, c] = 0
+
+    return image
+
+
+# lookup tables are built on first use
+_LUTS = {}
+
+
+def cached_table(name, builder):
+
+    if name not in _LUTS:
+        _LUTS[name] = builder()
+
+    return _LUTS[name]
+
+
+# Guo-Hall thinning of a binary image, the same skeleton as skimage.morphology.thin, return bool image
+def guo_hall_thinning(image):
+
+    (lut1, lut2) = cached_table('guo_hall', guo_hall_luts)
+
+    return lut_thinning(np.ascontiguousarray(image, dtype = bool).astype(np.uint8), lut1, lut2).astype(bool)
+
+
+# Zhang-Suen thinning of a binary image, return bool image
+def zhang_suen_thinning(image):
+
+    (lut1, lut2) = cached_table('zhang_suen', zhang_suen_luts)
+
+    return lut_thinning(np.ascontiguousarray(image, dtype = bool).astype(np.uint8), lut1, lut2).astype(bool)
+
+
+# medial axis of a binary image from its Euclidean distance transform, the pixels are removed in the order of increasing distance,
+# pixels with more background neighbors are removed later, the remaining ties in raster order, return bool image
+def medial_axis_skeleton(image, distance):
+
+    image = np.ascontiguousarray(image, dtype = bool)
+
+    (rows, cols) = np.nonzero(image)
+
+    # number of background pixels in the 3 x 3 neighborhood
+    padded = np.pad(image, 1).astype(np.uint8)
+
+    neighbors = sum(padded[1 + dr:1 + dr + image.shape[0], 1 + dc:1 + dc + image.shape[1]] for dr in (-1, 0, 1) for dc in (-1, 0, 1))
+
+    cornerness = 9 - neighbors[rows, cols]
+
+    order = np.lexsort((cornerness, distance[rows, cols])).astype(np.int64)
+
+    table = cached_table('medial_axis', medial_axis_table)
+
+    return ordered_removal(image.astype(np.uint8), rows.astype(np.int64), cols.astype(np.int64), order, table).astype(bool)
@@ -16,75 +16,93 @@ USAGE:
     python3 smart_release.py -p ~/example/AR_data/test/ -ai 1
     
     python3 smart_release.py -p ~/example/AR_data/test/ -ai 0
+    
+    python3 smart_release.py -p ~/example/AR_data/test/ -ai 1 -w 12 -pt process
+    
+    python3 smart_release.py -p ~/example/AR_data/test/ -ai 1 -tr leaf_area,solidity -d 0
+    
+    python3 smart_release.py -p ~/example/AR_data/test/ -ai 1 -w 12 -v 0
+    
+    python3 smart_release.py -p ~/example/AR_data/test/ -ai 0 -sc 0.25
 
 '''
 
 # import the necessary packages
+# scikit-learn, scikit-image, scipy, matplotlib, openpyxl and rembg (onnxruntime) are imported by the functions using them, 
+# so that runs which do not reach a code path, such as -ai 0 or fully cached runs, do not pay for its import
 import subprocess, os, glob, sys
 import utils, shutil
+import color_metrics
 
 from collections import Counter
 from collections import OrderedDict
 
 import argparse
 
-from sklearn.cluster import KMeans
-from sklearn.cluster import MiniBatchKMeans
-
-from skimage.feature import peak_local_max
-from skimage.morphology import medial_axis
-from skimage import img_as_float, img_as_ubyte, img_as_bool, img_as_int
-from skimage import measure
-from skimage.color import rgb2lab, deltaE_cie76
-from skimage import morphology
-from skimage.segmentation import clear_border, watershed
-from skimage.measure import regionprops
-
-from scipy.spatial import distance as dist
-from scipy import optimize
-from scipy import ndimage
-from scipy.interpolate import interp1d
-
-#from skan import skeleton_to_csgraph, Skeleton, summarize, draw
-
-#import networkx as nx
-
-import imutils
-
 import numpy as np
-import argparse
 import cv2
 
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
-
 import math
-import openpyxl
 import csv
-    
-from tabulate import tabulate
+import logging
 
 import warnings
 warnings.filterwarnings("ignore")
 
-import psutil
+import heapq
+import hashlib
+import time
+import json
+import tempfile
 import concurrent.futures
+import threading
+import queue
 import multiprocessing
-from multiprocessing import Pool
-from contextlib import closing
+import multiprocessing.util
 
 from pathlib import Path
 
-from rembg import remove
+import pathlib
 
-from matplotlib import collections
 
-import matplotlib.colors
+MBFACTOR = float(1<<20)
 
-import pathlib
 
+# messages are formatted lazily by the logging module, so messages below the verbosity level cost no string formatting
+logger = logging.getLogger('smart')
 
-MBFACTOR = float(1<<20)
+# name of the image processed by the current thread, added to every log record
+image_context = threading.local()
+
+
+# add the name of the image being processed to the log records
+class ImageContextFilter(logging.Filter):
+    
+    def filter(self, record):
+        """ set record.image, '-' outside of an image """
+        record.image = getattr(image_context, 'name', '-')
+        return True
+
+
+# set the verbosity level, 0 = warnings and errors only, 1 = progress and summary, 2 = details of each pipeline stage
+def setup_logging(verbose = 1):
+    
+    level = logging.WARNING if verbose <= 0 else (logging.INFO if verbose == 1 else logging.DEBUG)
+    
+    logger.setLevel(level)
+    
+    # one handler per process, set_parameters is called again by each worker process
+    if not logger.handlers:
+        
+        handler = logging.StreamHandler(sys.stdout)
+        
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(processName)s %(image)s | %(message)s', datefmt = '%H:%M:%S'))
+        
+        handler.addFilter(ImageContextFilter())
+        
+        logger.addHandler(handler)
+        
+        logger.propagate = False
 
 
 # check file type
@@ -140,6 +158,7 @@ class ComputeCurvature:
         return df_dc
 
     def fit(self, xx, yy):
+        from scipy import optimize
         self.xx = xx
         self.yy = yy
         center_estimate = np.r_[np.mean(xx), np.mean(yy)]
@@ -152,7 +171,7 @@ class ComputeCurvature:
         return 1 / self.r  # Return the curvature
 
 
-# color label class
+# color label class, the palette is immutable and shared by all threads, see COLOR_LABELER
 class ColorLabeler:
     def __init__(self):
         # initialize the colors dictionary, containing the color
@@ -182,63 +201,106 @@ class ColorLabeler:
             "neutral 5": (122, 122, 121),
             "neutral 3.5": (85, 85, 85),
             "black": (52, 52, 52)})
-        # allocate memory for the L*a*b* image, then initialize
-        # the color names list
-        self.lab = np.zeros((len(colors), 1, 3), dtype="uint8")
-        self.colorNames = []
-        # loop over the colors dictionary
-        for (i, (name, rgb)) in enumerate(colors.items()):
-            # update the L*a*b* array and the color names list
-            self.lab[i] = rgb
-            self.colorNames.append(name)
-        # convert the L*a*b* array from the RGB color space
-        # to L*a*b*
-        self.lab = cv2.cvtColor(self.lab, cv2.COLOR_RGB2LAB)
+        
+        # the color names and the L*a*b* values of the palette in OpenCV 8-bit scale, converted from RGB once
+        self.colorNames = tuple(colors.keys())
+        
+        self.lab = cv2.cvtColor(np.asarray(list(colors.values()), dtype = np.uint8).reshape((-1, 1, 3)), cv2.COLOR_RGB2LAB)
+        
+        self.lab_values = self.lab.reshape((-1, 3)).astype(np.float64)
+        
+        self.lab.flags.writeable = False
+        self.lab_values.flags.writeable = False
+        
+        # lookup table of uint8 L*a*b* values, built on first use
+        self.lut = None
+        self.lut_lock = threading.Lock()
         #print("color_checker values:{}\n".format(self.lab))
 
+    def nearest(self, lab_values):
+        """ index of the nearest palette color of each L*a*b* value, array of shape (N, 3) """
+        lab_values = np.asarray(lab_values, dtype = np.float64).reshape((-1, 3))
+        
+        # squared euclidean distance to all palette colors, the first color wins a tie as in the sequential search
+        distance = ((lab_values[:, np.newaxis, :] - self.lab_values[np.newaxis, :, :])**2).sum(axis = 2)
+        
+        return distance.argmin(axis = 1)
+
+    def label_colors(self, lab_values):
+        """ names of the nearest palette colors of an array of L*a*b* values, e.g. all color clusters of an image """
+        return [self.colorNames[i] for i in self.nearest(lab_values)]
+
+    def lookup_table(self):
+        """ nearest palette index of every uint8 L*a*b* value, 256 x 256 x 256 uint8 table (16 MB) """
+        with self.lut_lock:
+            
+            if self.lut is None:
+                
+                lut = np.empty((256, 256, 256), dtype = np.uint8)
+                
+                # the squared distance is separable, exact in integers: (L - cL)^2 + (a - ca)^2 + (b - cb)^2
+                (dL, da, db) = ((np.arange(256)[:, np.newaxis] - self.lab.reshape((-1, 3))[:, channel].astype(np.int32))**2 for channel in range(3))
+                
+                dab = da[:, np.newaxis, :] + db[np.newaxis, :, :]
+                
+                # one L* plane at a time keeps the distance matrix small
+                for L in range(256):
+                    lut[L] = (dab + dL[L]).argmin(axis = 2)
+                
+                lut.flags.writeable = False
+                
+                self.lut = lut
+            
+            return self.lut
+
+    def label_uint8(self, lab_values):
+        """ nearest palette index of uint8 L*a*b* values of any shape (..., 3), e.g. a whole image, through the lookup table """
+        lab_values = np.asarray(lab_values, dtype = np.uint8)
+        
+        return self.lookup_table()[lab_values[..., 0], lab_values[..., 1], lab_values[..., 2]]
+
+    def mean_colors(self, image, contours):
+        """ mean L*a*b* value inside each eroded contour, array of shape (N, 3) """
+        (height, width) = image.shape[:2]
+        
+        means = np.zeros((len(contours), 3), dtype = np.float64)
+        
+        for (i, c) in enumerate(contours):
+            
+            # mask of the bounding box only, the margin of 2 pixels keeps the erosion identical to a full image mask
+            (x, y, w, h) = cv2.boundingRect(c)
+            
+            (x0, y0, x1, y1) = (max(x - 2, 0), max(y - 2, 0), min(x + w + 2, width), min(y + h + 2, height))
+            
+            mask = np.zeros((y1 - y0, x1 - x0), dtype = "uint8")
+            cv2.drawContours(mask, [c], -1, 255, -1, offset = (-x0, -y0))
+            mask = cv2.erode(mask, None, iterations=2)
+            
+            means[i] = cv2.mean(image[y0:y1, x0:x1], mask=mask)[:3]
+        
+        return means
+
+    def label_contours(self, image, contours):
+        """ names and mean L*a*b* values of a list of contours of a L*a*b* image, labeled in one call """
+        means = self.mean_colors(image, contours)
+        
+        return self.label_colors(means), [tuple(mean) for mean in means]
+
     def label(self, image, c):
             # construct a mask for the contour, then compute the
             # average L*a*b* value for the masked region
-            mask = np.zeros(image.shape[:2], dtype="uint8")
-            cv2.drawContours(mask, [c], -1, 255, -1)
-            mask = cv2.erode(mask, None, iterations=2)
-            mean = cv2.mean(image, mask=mask)[:3]
-
-            # initialize the minimum distance found thus far
-            minDist = (np.inf, None)
-            # loop over the known L*a*b* color values
-            for (i, row) in enumerate(self.lab):
-                # compute the distance between the current L*a*b*
-                # color value and the mean of the image
-                d = dist.euclidean(row[0], mean)
-                
-                #print("mean = {0}, row = {1}, d = {2}, i = {3}\n".format(mean, row[0], d, i)) 
-                
-                # if the distance is smaller than the current distance,
-                # then update the bookkeeping variable
-                if d < minDist[0]:
-                    minDist = (d, i)
+            (names, means) = self.label_contours(image, [c])
+            
             # return the name of the color with the smallest distance
-            return self.colorNames[minDist[1]], mean
+            return names[0], means[0]
 
     def label_c(self, lab_color_value):
-            # initialize the minimum distance found thus far
-            minDist = (np.inf, None)
-           
-            # loop over the known L*a*b* color values
-            for (i, row) in enumerate(self.lab):
-                # compute the distance between the current L*a*b*
-                # color value and the mean of the image
-                d = dist.euclidean(row[0], lab_color_value)
-                
-                #print("mean = {0}, row = {1}, d = {2}, i = {3}\n".format(mean, row[0], d, i)) 
-                
-                # if the distance is smaller than the current distance,
-                # then update the bookkeeping variable
-                if d < minDist[0]:
-                    minDist = (d, i)
             # return the name of the color with the smallest distance
-            return self.colorNames[minDist[1]]
+            return self.label_colors(lab_color_value)[0]
+
+
+# palette shared by all images and threads
+COLOR_LABELER = ColorLabeler()
 
 
 # generate foloder to store the output results
@@ -265,13 +327,14 @@ def mkdir(path):
         # if exists, return 
         shutil.rmtree(path)
         os.makedirs(path)
-        print("{} path exists!\n".format(path))
+        logger.debug("%s path exists!", path)
         return False
         
 
 
 # find the closest point wihch minimize the distance between current point and the center of image
 def closest_node(pt, pts):
+    from scipy.spatial import distance as dist
     
     closest_index = dist.cdist([pt], pts).argmin()
     
@@ -301,44 +364,232 @@ def merge_contours(contour1, contour2):
     #return np.vstack([contour1, contour2])
 
 
+# distance between one bounding box and an array of bounding boxes (x, y, w, h), same definition as calculate_contour_distance
+def bounding_box_distance(box, boxes):
+    
+    (x1, y1, w1, h1) = box
+    c_x1 = x1 + w1/2
+    c_y1 = y1 + h1/2
+    
+    c_x2 = boxes[:, 0] + boxes[:, 2]/2
+    c_y2 = boxes[:, 1] + boxes[:, 3]/2
+    
+    return np.maximum(np.abs(c_x1 - c_x2) - (w1 + boxes[:, 2])/2, np.abs(c_y1 - c_y2) - (h1 + boxes[:, 3])/2)
+
+
 #group contours such that one contour corresponds to one object.
 #when some contours that belong to the same object are detected separately
+#bounding boxes are computed once, the closest pair is taken from a priority queue of box distances, 
+#and only the distances of the merged pair to the other contours are updated
 def agglomerative_cluster(contours, threshold_distance=40.0):
     
-    current_contours = contours
-    while len(current_contours) > 1:
-        min_distance = None
-        min_coordinate = None
-
-        for x in range(len(current_contours)-1):
-            for y in range(x+1, len(current_contours)):
-                distance = calculate_contour_distance(current_contours[x], current_contours[y])
-                if min_distance is None:
-                    min_distance = distance
-                    min_coordinate = (x, y)
-                elif distance < min_distance:
-                    min_distance = distance
-                    min_coordinate = (x, y)
-
-        if min_distance < threshold_distance:
-            index1, index2 = min_coordinate
-            current_contours[index1] = merge_contours(current_contours[index1], current_contours[index2])
-            del current_contours[index2]
-        else: 
-            break
+    current_contours = list(contours)
+    
+    n_contours = len(current_contours)
+    
+    if n_contours < 2:
+        return current_contours
+    
+    # bounding box of each contour, a merged contour has the union box of its parts
+    boxes = np.array([cv2.boundingRect(c) for c in current_contours], dtype = np.float64)
+    
+    alive = np.ones(n_contours, dtype = bool)
+    
+    # version of each contour, increased when it was merged, to skip outdated queue entries
+    version = np.zeros(n_contours, dtype = np.int64)
+    
+    # only pairs closer than the threshold can be merged, merging never increases the distance to other boxes
+    queue = []
+    
+    for x in range(n_contours - 1):
+        
+        distance = bounding_box_distance(boxes[x], boxes[x+1:])
+        
+        for offset in np.flatnonzero(distance < threshold_distance):
+            queue.append((distance[offset], x, x + 1 + offset, 0, 0))
+    
+    heapq.heapify(queue)
+    
+    # ties are broken by the contour order, the same as the exhaustive pairwise search
+    while queue:
+        
+        (min_distance, index1, index2, version1, version2) = heapq.heappop(queue)
+        
+        if not (alive[index1] and alive[index2]) or version[index1] != version1 or version[index2] != version2:
+            continue
+        
+        current_contours[index1] = merge_contours(current_contours[index1], current_contours[index2])
+        current_contours[index2] = None
+        
+        # union of the two bounding boxes
+        (x1, y1, w1, h1) = boxes[index1]
+        (x2, y2, w2, h2) = boxes[index2]
+        
+        x = min(x1, x2)
+        y = min(y1, y2)
+        boxes[index1] = (x, y, max(x1 + w1, x2 + w2) - x, max(y1 + h1, y2 + h2) - y)
+        
+        alive[index2] = False
+        version[index1] += 1
+        
+        # update the distances between the merged contour and its neighbors
+        others = np.flatnonzero(alive)
+        others = others[others != index1]
+        
+        distance = bounding_box_distance(boxes[index1], boxes[others])
+        
+        for other, value in zip(others[distance < threshold_distance], distance[distance < threshold_distance]):
+            
+            (a, b) = (other, index1) if other < index1 else (index1, other)
+            
+            heapq.heappush(queue, (value, a, b, version[a], version[b]))
+
+    return [c for c in current_contours if c is not None]
+
+
+
+# stratified random sample of pixel indices, one random pixel from each of sample_size equal runs of the flattened image
+def stratified_sample_index(n_pixels, sample_size, seed = None):
+    
+    if n_pixels <= sample_size:
+        return np.arange(n_pixels)
+    
+    rng = np.random.default_rng(seed)
+    
+    stride = n_pixels / float(sample_size)
+    
+    sample_index = (np.arange(sample_size) * stride + rng.random(sample_size) * stride).astype(np.int64)
+    
+    return np.minimum(sample_index, n_pixels - 1)
+
+
+# assign every feature vector to its nearest cluster center, processed in chunks to limit memory
+def nearest_center_label(features, centers, chunk_size = 1 << 20):
+    
+    centers = np.asarray(centers, dtype = np.float32)
+    
+    labels = np.empty(features.shape[0], dtype = np.int32)
+    
+    for start in range(0, features.shape[0], chunk_size):
+        
+        block = features[start:start + chunk_size].astype(np.float32)
+        
+        # squared euclidean distance between pixels and centers
+        distance = ((block[:, np.newaxis, :] - centers[np.newaxis, :, :])**2).sum(axis = 2)
+        
+        labels[start:start + chunk_size] = distance.argmin(axis = 1)
+    
+    return labels
 
-    return current_contours
 
+# exact (globally optimal) 1-D K-means clustering of uint8 values, computed on the 256-bin weighted histogram
+# by dynamic programming, labels are mapped back to all pixels through a lookup table
+def kmeans_1d_histogram(values, numClusters):
+    
+    hist = np.bincount(values.ravel(), minlength = 256).astype(np.float64)
+    
+    # distinct values present in the image and their counts
+    levels = np.flatnonzero(hist)
+    weights = hist[levels]
+    x = levels.astype(np.float64)
+    
+    n_levels = len(levels)
+    n_clusters = min(numClusters, n_levels)
+    
+    # prefix sums of weights, weighted values and weighted squared values
+    W = np.concatenate(([0.0], np.cumsum(weights)))
+    S = np.concatenate(([0.0], np.cumsum(weights * x)))
+    Q = np.concatenate(([0.0], np.cumsum(weights * x * x)))
+    
+    # within-cluster sum of squares of a cluster made of levels i..j
+    i = np.arange(n_levels)[:, np.newaxis]
+    j = np.arange(n_levels)[np.newaxis, :]
+    
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        cost = (Q[j + 1] - Q[i]) - (S[j + 1] - S[i])**2 / (W[j + 1] - W[i])
+    
+    cost[np.broadcast_to(i > j, cost.shape)] = np.inf
+    
+    # D[m, j]: minimal cost of clustering levels 0..j into m + 1 clusters, B[m, j]: first level of the last cluster
+    D = np.full((n_clusters, n_levels), np.inf)
+    B = np.zeros((n_clusters, n_levels), dtype = np.int64)
+    
+    D[0] = cost[0]
+    
+    for m in range(1, n_clusters):
+        
+        candidates = D[m - 1][:-1, np.newaxis] + cost[1:, :]
+        
+        B[m] = candidates.argmin(axis = 0) + 1
+        D[m] = candidates.min(axis = 0)
+    
+    # backtrack the optimal cluster boundaries
+    level_labels = np.zeros(n_levels, dtype = np.uint8)
+    centers = np.zeros((n_clusters, 1))
+    
+    end = n_levels - 1
+    
+    for m in range(n_clusters - 1, -1, -1):
+        
+        start = B[m, end] if m > 0 else 0
+        
+        level_labels[start:end + 1] = m
+        centers[m, 0] = (S[end + 1] - S[start]) / (W[end + 1] - W[start])
+        
+        end = start - 1
+    
+    # lookup table from value to cluster label
+    lut = np.zeros(256, dtype = np.uint8)
+    lut[levels] = level_labels
+    
+    return lut[values.ravel()], centers
 
 
-# segment foreground object using color clustering method
-def color_cluster_seg(image, args_colorspace, args_channels, args_num_clusters):
+# K-means clustering of pixel feature vectors, return the label of every pixel and the cluster centers
+# engine: 'exact' fits all pixels, 'sample' fits a stratified pixel sample, 'minibatch' fits a MiniBatchKMeans stream over all pixels,
+# 'histogram' clusters the histogram of single channel uint8 features, 'auto' uses histogram if possible, otherwise sample
+def kmeans_cluster(features, numClusters, engine = 'exact', sample_size = 100000, seed = None):
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+    
+    single_channel = features.shape[1] == 1 and features.dtype == np.uint8
+    
+    if engine == 'auto':
+        engine = 'histogram' if single_channel else 'sample'
+    
+    if engine == 'histogram':
+        
+        if not single_channel:
+            raise ValueError("Histogram clustering engine requires single channel uint8 features")
+        
+        return kmeans_1d_histogram(features[:, 0], numClusters)
+    
+    elif engine == 'exact':
+        
+        kmeans = KMeans(n_clusters = numClusters, n_init = 40, max_iter = 500, random_state = seed).fit(features)
+        
+        return kmeans.labels_, kmeans.cluster_centers_
     
+    elif engine == 'sample':
+        
+        sample_index = stratified_sample_index(features.shape[0], sample_size, seed)
+        
+        kmeans = KMeans(n_clusters = numClusters, n_init = 40, max_iter = 500, random_state = seed).fit(features[sample_index])
     
+    elif engine == 'minibatch':
+        
+        kmeans = MiniBatchKMeans(n_clusters = numClusters, n_init = 3, batch_size = 4096, random_state = seed).fit(features)
     
-    image_LAB = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
+    else:
+        
+        raise ValueError("Unknown clustering engine: {}".format(engine))
     
-    cl = ColorLabeler()
+    # label all pixels with one vectorized nearest-center pass
+    return nearest_center_label(features, kmeans.cluster_centers_), kmeans.cluster_centers_
+
+
+
+# convert the image to the color space and channels used for clustering, return the feature image of shape (height, width, number of channels)
+def clustering_features(image, args_colorspace, args_channels):
     
     # Change image color space, if necessary.
     colorSpace = args_colorspace.lower()
@@ -357,64 +608,59 @@ def color_cluster_seg(image, args_colorspace, args_channels, args_num_clusters):
 
     # Keep only the selected channels for K-means clustering.
     if args_channels != 'all':
-        channels = cv2.split(image)
         channelIndices = []
         for char in args_channels:
             channelIndices.append(int(char))
         image = image[:,:,channelIndices]
-        if len(image.shape) == 2:
-            image.reshape(image.shape[0], image.shape[1], 1)
-            
-    (height, width, n_channel) = image.shape
     
-    if n_channel > 1:
-        
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    else:
-        gray = image
-        
- 
+    return image
+
+
+
+# K-means clustering of the feature image and Otsu threshold of the cluster levels,
+# return the binary mask, the cluster centers and whether each cluster belongs to the foreground
+def cluster_threshold(image, args_num_clusters, engine = 'exact', sample_size = 100000, seed = None):
+    
     # Flatten the 2D image array into an MxN feature vector, where M is the number of pixels and N is the dimension (number of channels).
     reshaped = image.reshape(image.shape[0] * image.shape[1], image.shape[2])
     
     # Perform K-means clustering.
     if args_num_clusters < 2:
-        print('Warning: num-clusters < 2 invalid. Using num-clusters = 2')
+        logger.warning('num-clusters < 2 invalid. Using num-clusters = 2')
     
     # define number of cluster, at lease 2 cluster including background
     numClusters = max(2, args_num_clusters)
     
-    # clustering method
-    kmeans = KMeans(n_clusters = numClusters, n_init = 40, max_iter = 500).fit(reshaped)
-    
-    # get lables 
-    pred_label = kmeans.labels_
+    # clustering method, get lables 
+    (pred_label, cluster_centers) = kmeans_cluster(reshaped, numClusters, engine, sample_size, seed)
     
     # Reshape result back into a 2D array, where each element represents the corresponding pixel's cluster index (0 to K - 1).
     clustering = np.reshape(np.array(pred_label, dtype=np.uint8), (image.shape[0], image.shape[1]))
 
     # Sort the cluster labels in order of the frequency with which they occur.
-    sortedLabels = sorted([n for n in range(numClusters)],key = lambda x: -np.sum(clustering == x))
+    cluster_sizes = np.bincount(clustering.ravel(), minlength = numClusters)
+    
+    sortedLabels = sorted([n for n in range(numClusters)],key = lambda x: -cluster_sizes[x])
 
     # Initialize K-means grayscale image; set pixel colors based on clustering.
-    kmeansImage = np.zeros(image.shape[:2], dtype=np.uint8)
+    levels = np.zeros(numClusters, dtype=np.uint8)
     for i, label in enumerate(sortedLabels):
-        kmeansImage[clustering == label] = int(255 / (numClusters - 1)) * i
+        levels[label] = int(255 / (numClusters - 1)) * i
+    
+    kmeansImage = levels[clustering]
     
     ret, thresh = cv2.threshold(kmeansImage,0,255,cv2.THRESH_BINARY | cv2.THRESH_OTSU)
     
-    '''
-    if args['out_boundary']:
-        thresh_cleaned = (thresh)
+    return thresh, cluster_centers, levels > ret
+
+
+
+# keep the connected components of the mask which do not touch the image border and pass the size tests,
+# frame_shape is the shape of the full image if thresh is a crop of it with a background margin, used by the width and height tests
+def select_components(thresh, min_size, max_size, frame_shape = None):
+    from skimage.segmentation import clear_border
     
-    else:
-        
-        if np.count_nonzero(thresh) > 0:
-            
-            thresh_cleaned = clear_border(thresh)
-        else:
-            thresh_cleaned = thresh
-    '''
+    (height, width) = thresh.shape[:2] if frame_shape is None else frame_shape[:2]
     
     if np.count_nonzero(thresh) > 0:
         
@@ -423,96 +669,41 @@ def color_cluster_seg(image, args_colorspace, args_channels, args_num_clusters):
         thresh_cleaned = thresh
 
     (numLabels, labels, stats, centroids) = cv2.connectedComponentsWithStats(thresh_cleaned, connectivity = 8)
-
-    '''
-    # stats[0], centroids[0] are for the background label. ignore
-    # cv2.CC_STAT_LEFT, cv2.CC_STAT_TOP, cv2.CC_STAT_WIDTH, cv2.CC_STAT_HEIGHT
-    
-    # extract the connected component statistics for the current label
-    sizes = stats[1:, cv2.CC_STAT_AREA]
-    Coord_left = stats[1:, cv2.CC_STAT_LEFT]
-    Coord_top = stats[1:, cv2.CC_STAT_TOP]
-    Coord_width = stats[1:, cv2.CC_STAT_WIDTH]
-    Coord_height = stats[1:, cv2.CC_STAT_HEIGHT]
-    Coord_centroids = np.delete(centroids,(0), axis=0)
-    
-
-    
-    #print("Coord_centroids {}\n".format(centroids[1][1]))
-    
-    #print("[width, height] {} {}\n".format(width, height))
     
-    numLabels = numLabels - 1
-    '''
-
-    
-    
-    ################################################################################################
-    
-
-    if args['max_size'] == 1000000:
-        
-        max_size = width*height
-    else:
-        max_size = args['max_size']
-    
-    # initialize an output mask 
-    mask = np.zeros(gray.shape, dtype="uint8")
+    # whether each component is kept, label zero is the background
+    keep = np.zeros(numLabels, dtype = bool)
     
     # loop over the number of unique connected component labels, skipping
     # over the first label (as label zero is the background)
     for i in range(1, numLabels):
     # extract the connected component statistics for the current label
-        x = stats[i, cv2.CC_STAT_LEFT]
-        y = stats[i, cv2.CC_STAT_TOP]
         w = stats[i, cv2.CC_STAT_WIDTH]
         h = stats[i, cv2.CC_STAT_HEIGHT]
         area = stats[i, cv2.CC_STAT_AREA]
         
-        
-        # define plant object center
-        #x_center = int(width // 3)
-        #y_center = int(height // 2)
-        
-        #print("x_center,y_center = {} {}".format(x_center, y_center))
-        #print("x,y = {} {}".format(x, y))
-        
-        #distance = math.dist((x_center, y_center), (x, y))
-        #print("ditance = {}\n".format(distance))
-        
-    
-        #if w>img_width*0.01 and h>img_height*0.01:
         # ensure the width, height, and area are all neither too small
         # nor too big
         keepWidth = w > width*0.01 and w < 50000
         keepHeight = h > height*0.01 and h < 50000
         keepArea = area > min_size and area < max_size
-        #keepDistance = distance < 800
-        
         
         if all((keepWidth, keepHeight, keepArea)):
-        # ensure the connected component we are examining passes all three tests
-        #if all((keepWidth, keepHeight)):
-        #if keepArea:
-        # construct a mask for the current connected component and
-        # then take the bitwise OR with the mask
-            print("[INFO] keeping connected component '{}'".format(i))
-            componentMask = (labels == i).astype("uint8") * 255
-            mask = cv2.bitwise_or(mask, componentMask)
-            
-
-    img_thresh = mask
-    
+            logger.debug("keeping connected component '%s'", i)
+            keep[i] = True
     
-    ###################################################################################################
-    size_kernel = 5
+    # mask of all kept components in one lookup
+    return keep[labels].astype(np.uint8) * 255
+
+
+
+#if mask contains mutiple non-connected parts, combine them into one. 
+def merge_mask_parts(img_thresh, size_kernel = 5):
     
-    #if mask contains mutiple non-connected parts, combine them into one. 
     (contours, hier) = cv2.findContours(img_thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
     if len(contours) > 1:
         
-        print("mask contains mutiple non-conected parts, combine them into one\n")
+        logger.debug("mask contains mutiple non-conected parts, combine them into one")
         
         kernel = np.ones((size_kernel,size_kernel), np.uint8)
 
@@ -521,46 +712,206 @@ def color_cluster_seg(image, args_colorspace, args_channels, args_num_clusters):
         closing = cv2.morphologyEx(dilation, cv2.MORPH_CLOSE, kernel)
         
         img_thresh = closing
-        
-        
-
-        
-        ###########################################################################
-    '''
-    if args["cue_color"] == 1:
     
-        img_mask = np.zeros([height, width], dtype="uint8")
-        
-        #img_mask = np.zeros(gray.shape, dtype="uint8")
-         
-        # filter contours by color cue
-        for idx, c in enumerate(contours):
-            
-            # compute the center of the contour
-            M = cv2.moments(c)
-            cX = int(M["m10"] / M["m00"])
-            cY = int(M["m01"] / M["m00"])
-        
-            (color_name, color_value) = cl.label(image_LAB, c)
-            
-            #img_thresh = cv2.putText(img_thresh, "{}".format(color_name), (int(cX), int(cY)), cv2.FONT_HERSHEY_SIMPLEX, 1.8, (255, 0, 0), 2)
-            
-            print(color_name)
-            
-            keepColor = color_name == "foliage"  or color_name == "green" 
-            
-            #or color_name == "dark skin" or color_name == "light skin"
+    return img_thresh
 
-            if keepColor:
-                
-                #img_mask = cv2.drawContours(img_mask, c, -1, (255), -1)
-                img_mask = cv2.drawContours(image=img_mask, contours=[c], contourIdx=-1, color=(255,255,255), thickness=cv2.FILLED)
-                #img_mask = cv2.fillPoly(img_mask, pts = [contours], color =(255,255,255))
-       
-       
-            img_thresh = img_mask
+
+
+# binary mask of the pixels whose nearest cluster center belongs to the foreground
+def cluster_mask(image, args_colorspace, args_channels, cluster_centers, foreground):
     
-    '''
+    features = clustering_features(image, args_colorspace, args_channels)
+    
+    labels = nearest_center_label(features.reshape((-1, features.shape[2])), cluster_centers)
+    
+    return np.where(foreground[labels], 255, 0).astype(np.uint8).reshape(image.shape[:2])
+
+
+
+# fill the holes of the mask
+def fill_mask_holes(mask):
+    
+    (contours, hier) = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    
+    return cv2.drawContours(np.zeros_like(mask), contours, -1, 255, thickness = cv2.FILLED)
+
+
+
+# full resolution pixels of the coarse mask in its bounding box, return the bool mask and the box (x, y, w, h) in full resolution, 
+# the box is padded by margin pixels and clipped to the image, row_index and col_index map full resolution rows and columns to coarse ones
+def coarse_mask_crop(mask, row_index, col_index, margin):
+    
+    (x, y, w, h) = cv2.boundingRect(mask)
+    
+    if w == 0 or h == 0:
+        return None, None
+    
+    (y0, y1) = (max(np.searchsorted(row_index, y) - margin, 0), min(np.searchsorted(row_index, y + h) + margin, len(row_index)))
+    (x0, x1) = (max(np.searchsorted(col_index, x) - margin, 0), min(np.searchsorted(col_index, x + w) + margin, len(col_index)))
+    
+    return mask[np.ix_(row_index[y0:y1], col_index[x0:x1])] > 0, (x0, y0, x1 - x0, y1 - y0)
+
+
+
+# coarse to fine segmentation: the cluster centers are fitted on a stratified sample of full resolution pixels,
+# the plant regions are located on the image downscaled by scale with these centers, then every pixel of the regions, 
+# of their holes and of a band of band_width coarse pixels around them is classified again at full resolution,
+# where foreground reaches the edge of the regions, e.g. thin leaf stalks lost at the coarse scale, the regions are grown,
+# the components are selected at full resolution, so the background far from the plant is not processed at full resolution
+# the mask differs from the full resolution mask where the sampled centers move the cluster boundary, 
+# or where a plant component is not located at the coarse scale, e.g. a component touching the image border only at the coarse scale
+def color_cluster_seg_pyramid(image, args_colorspace, args_channels, args_num_clusters, engine = 'exact', sample_size = 100000, seed = None, scale = 0.25, band_width = 2):
+    
+    if not 0 < scale < 1:
+        raise ValueError("Segmentation scale must be between 0 and 1, got {}".format(scale))
+    
+    (height, width) = image.shape[:2]
+    
+    # cluster centers and foreground clusters of a full resolution pixel sample
+    pixels = image.reshape((-1, image.shape[2]))
+    
+    sample = pixels[stratified_sample_index(pixels.shape[0], sample_size, seed)].reshape((-1, 1, image.shape[2]))
+    
+    (sample_thresh, cluster_centers, foreground) = cluster_threshold(clustering_features(sample, args_colorspace, args_channels), args_num_clusters, engine, sample_size, seed)
+    
+    # locate the plant regions at the coarse scale
+    coarse = cv2.resize(image, (max(1, int(round(width*scale))), max(1, int(round(height*scale)))), interpolation = cv2.INTER_AREA)
+    
+    (coarse_height, coarse_width) = coarse.shape[:2]
+    
+    # area of one coarse pixel in full resolution pixels
+    scale_area = (coarse_height * coarse_width) / float(height * width)
+    
+    # size limits in coarse pixels, the lower limit is halved as the final selection is done at full resolution
+    max_size = coarse_height*coarse_width if args['max_size'] == 1000000 else args['max_size']*scale_area
+    
+    grow = select_components(cluster_mask(coarse, args_colorspace, args_channels, cluster_centers, foreground), 0.5*min_size*scale_area, max_size)
+    
+    # coarse row and column of every full resolution row and column
+    row_index = np.arange(height) * coarse_height // height
+    col_index = np.arange(width) * coarse_width // width
+    
+    kernel = np.ones((3, 3), np.uint8)
+    
+    mask = np.zeros((height, width), dtype = np.uint8)
+    
+    regions = np.zeros_like(grow)
+    
+    while np.any(grow):
+        
+        # regions with their holes and the band
+        grown = fill_mask_holes(cv2.max(regions, cv2.dilate(grow, kernel, iterations = band_width)))
+        
+        # classify the pixels added to the regions at full resolution, only these pixels are converted
+        (new, box) = coarse_mask_crop(cv2.subtract(grown, regions), row_index, col_index, 1)
+        
+        if box is None:
+            break
+        
+        regions = grown
+        
+        mask_box = roi_crop(mask, box)
+        
+        mask_box[new] = cluster_mask(roi_crop(image, box)[new].reshape((-1, 1, image.shape[2])), args_colorspace, args_channels, cluster_centers, foreground).ravel()
+        
+        # new foreground pixels on the edge of the regions continue outside, the regions are grown from there
+        region = regions[np.ix_(row_index[box[1]:box[1] + box[3]], col_index[box[0]:box[0] + box[2]])]
+        
+        (rows, cols) = np.nonzero(new & (mask_box > 0) & (cv2.erode(region, kernel) == 0))
+        
+        grow = np.zeros_like(regions)
+        
+        grow[row_index[rows + box[1]], col_index[cols + box[0]]] = 255
+    
+    # the margin keeps the border exclusion and the merging of mask parts the same as on the full frame
+    roi_box = plant_roi(mask, 8)
+    
+    if roi_box is None:
+        return mask
+    
+    max_size = width*height if args['max_size'] == 1000000 else args['max_size']
+    
+    return roi_paste(merge_mask_parts(select_components(roi_crop(mask, roi_box), min_size, max_size, (height, width))), roi_box, (height, width))
+
+
+
+# segment foreground object using color clustering method, scale < 1 segments coarse to fine, see color_cluster_seg_pyramid
+def color_cluster_seg(image, args_colorspace, args_channels, args_num_clusters, engine = 'exact', sample_size = 100000, seed = None, scale = 1.0):
+    
+    if scale < 1.0:
+        return color_cluster_seg_pyramid(image, args_colorspace, args_channels, args_num_clusters, engine, sample_size, seed, scale)
+    
+    image = clustering_features(image, args_colorspace, args_channels)
+            
+    (height, width, n_channel) = image.shape
+    
+    (thresh, cluster_centers, foreground) = cluster_threshold(image, args_num_clusters, engine, sample_size, seed)
+    
+    '''
+    if args['out_boundary']:
+        thresh_cleaned = (thresh)
+    
+    else:
+        
+        if np.count_nonzero(thresh) > 0:
+            
+            thresh_cleaned = clear_border(thresh)
+        else:
+            thresh_cleaned = thresh
+    '''
+    
+    if args['max_size'] == 1000000:
+        
+        max_size = width*height
+    else:
+        max_size = args['max_size']
+    
+    # remove components touching the border, too small or too big
+    img_thresh = select_components(thresh, min_size, max_size)
+    
+    
+    ###################################################################################################
+    img_thresh = merge_mask_parts(img_thresh)
+        
+        
+
+        
+        ###########################################################################
+    '''
+    if args["cue_color"] == 1:
+    
+        img_mask = np.zeros([height, width], dtype="uint8")
+        
+        #img_mask = np.zeros(gray.shape, dtype="uint8")
+         
+        # filter contours by color cue
+        for idx, c in enumerate(contours):
+            
+            # compute the center of the contour
+            M = cv2.moments(c)
+            cX = int(M["m10"] / M["m00"])
+            cY = int(M["m01"] / M["m00"])
+        
+            (color_name, color_value) = COLOR_LABELER.label(cv2.cvtColor(orig, cv2.COLOR_BGR2LAB), c)
+            
+            #img_thresh = cv2.putText(img_thresh, "{}".format(color_name), (int(cX), int(cY)), cv2.FONT_HERSHEY_SIMPLEX, 1.8, (255, 0, 0), 2)
+            
+            logger.debug("%s", color_name)
+            
+            keepColor = color_name == "foliage"  or color_name == "green" 
+            
+            #or color_name == "dark skin" or color_name == "light skin"
+
+            if keepColor:
+                
+                #img_mask = cv2.drawContours(img_mask, c, -1, (255), -1)
+                img_mask = cv2.drawContours(image=img_mask, contours=[c], contourIdx=-1, color=(255,255,255), thickness=cv2.FILLED)
+                #img_mask = cv2.fillPoly(img_mask, pts = [contours], color =(255,255,255))
+       
+       
+            img_thresh = img_mask
+    
+    '''
         
     
     
@@ -590,7 +941,7 @@ def color_cluster_seg(image, args_colorspace, args_channels, args_num_clusters):
             #finding closest point among the grid points list ot the M coordinates
             idx_closest = closest_node((x_center,y_center), Coord_centroids) + 1
             
-            print("idx_closest = {}  {}".format(idx_closest, Coord_centroids[idx_closest]))
+            logger.debug("idx_closest = %s  %s", idx_closest, Coord_centroids[idx_closest])
             
             
             for i in range(1, numLabels):
@@ -625,6 +976,8 @@ def color_cluster_seg(image, args_colorspace, args_channels, args_num_clusters):
 
 # compute medial axis from the mask of image
 def medial_axis_image(thresh):
+    from skimage import img_as_float, img_as_bool
+    from skimage.morphology import medial_axis
     
     #convert an image from OpenCV to skimage
     thresh_sk = img_as_float(thresh)
@@ -636,8 +989,16 @@ def medial_axis_image(thresh):
     return image_medial_axis
 
 
-# compute the skeleton from the mask of image
-def skeleton_bw(thresh):
+# skeleton engines of skeleton_bw: thin = skimage.morphology.thin, guo_hall = the same Guo-Hall thinning as a numba kernel, 
+# zhang_suen = Zhang-Suen thinning (OpenCV contrib ximgproc if installed, otherwise numba kernel), medial_axis = medial axis from the distance transform,
+# auto = guo_hall if numba is installed, otherwise thin
+SKELETON_ENGINES = ['auto', 'thin', 'guo_hall', 'zhang_suen', 'medial_axis']
+
+
+# compute the skeleton from the mask of image, distance is the Euclidean distance transform of the mask if already computed, used by medial_axis
+def skeleton_bw(thresh, engine = 'thin', distance = None):
+    from skimage import img_as_float, img_as_bool
+    from skimage import morphology
 
     # Convert mask to boolean image, rather than 0 and 255 for skimage to use it
     
@@ -645,10 +1006,44 @@ def skeleton_bw(thresh):
     thresh_sk = img_as_float(thresh)
 
     image_bw = img_as_bool((thresh_sk))
+    
+    if engine == 'auto':
+        import importlib.util
+        
+        engine = 'guo_hall' if importlib.util.find_spec('numba') is not None else 'thin'
 
     #skeleton = morphology.skeletonize(image_bw)
     
-    skeleton = morphology.thin(image_bw)
+    if engine == 'thin':
+        
+        skeleton = morphology.thin(image_bw)
+    
+    elif engine == 'guo_hall':
+        import skeleton_kernels
+        
+        skeleton = skeleton_kernels.guo_hall_thinning(image_bw)
+    
+    elif engine == 'zhang_suen':
+        
+        if hasattr(cv2, 'ximgproc'):
+            skeleton = cv2.ximgproc.thinning(image_bw.astype(np.uint8) * 255, thinningType = cv2.ximgproc.THINNING_ZHANGSUEN) > 0
+        else:
+            import skeleton_kernels
+            
+            skeleton = skeleton_kernels.zhang_suen_thinning(image_bw)
+    
+    elif engine == 'medial_axis':
+        from scipy import ndimage
+        import skeleton_kernels
+        
+        if distance is None:
+            distance = ndimage.distance_transform_edt(image_bw)
+        
+        skeleton = skeleton_kernels.medial_axis_skeleton(image_bw, distance)
+    
+    else:
+        
+        raise ValueError("Unknown skeleton engine {}, choose from: {}".format(engine, ', '.join(SKELETON_ENGINES)))
     
     skeleton_img = skeleton.astype(np.uint8) * 255
 
@@ -657,13 +1052,17 @@ def skeleton_bw(thresh):
     return skeleton_img, skeleton
 
 
-# segmentation using wateshed method
-def watershed_seg(orig, thresh, min_distance_value):
+# segmentation using wateshed method, D is the Euclidean distance transform of the mask if already computed
+def watershed_seg(orig, thresh, min_distance_value, D = None):
+    from scipy import ndimage
+    from skimage.feature import peak_local_max
+    from skimage.segmentation import watershed
     
     # compute the exact Euclidean distance from every binary
     # pixel to the nearest zero pixel, then find peaks in this
     # distance map
-    D = ndimage.distance_transform_edt(thresh)
+    if D is None:
+        D = ndimage.distance_transform_edt(thresh)
     
     localMax = peak_local_max(D, indices = False, min_distance = min_distance_value,  labels = thresh)
      
@@ -676,11 +1075,77 @@ def watershed_seg(orig, thresh, min_distance_value):
     
     labels = watershed(-D, markers, mask = thresh)
     
-    print("[INFO] {} unique segments found\n".format(len(np.unique(labels)) - 1))
+    # counting the segments is only worth it if the message is shown
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%d unique segments found", len(np.unique(labels)) - 1)
     
     return labels
 
 
+# compute the traits of each individual leaf from the watershed label image, return a list of leaf records
+# offset (x, y) of the label image in the full frame, e.g. of the plant ROI, is added to the leaf coordinates
+def leaf_traits(labels, offset = (0, 0)):
+    from scipy import ndimage
+    
+    leaf_records = []
+    
+    (img_height, img_width) = labels.shape[:2]
+    
+    # bounding box of every label region, found in one pass over the label image
+    label_slices = ndimage.find_objects(labels)
+    
+    for label, label_slice in enumerate(label_slices, start = 1):
+        
+        if label_slice is None:
+            continue
+        
+        # crop the label region with one pixel margin
+        (slice_y, slice_x) = label_slice
+        
+        y_start = max(slice_y.start - 1, 0)
+        x_start = max(slice_x.start - 1, 0)
+        
+        mask = (labels[y_start:min(slice_y.stop + 1, img_height), x_start:min(slice_x.stop + 1, img_width)] == label).astype(np.uint8) * 255
+        
+        # contour coordinates are shifted back to the full image frame
+        contours, hierarchy = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE, offset = (x_start + offset[0], y_start + offset[1]))
+        
+        # every label has a record, traits which can not be computed are NaN
+        record = {'leaf_index': label, 'area': np.nan, 'curvature': np.nan, 'solidity': np.nan, 
+                  'major_axis': np.nan, 'minor_axis': np.nan, 'center_x': np.nan, 'center_y': np.nan}
+        
+        leaf_records.append(record)
+        
+        if len(contours) == 0:
+            continue
+        
+        c = max(contours, key = cv2.contourArea)
+        
+        area = cv2.contourArea(c)
+        
+        hull_area = cv2.contourArea(cv2.convexHull(c))
+        
+        record.update(area = float(area), solidity = float(area)/hull_area if hull_area > 0 else 0.0)
+        
+        # fitEllipse needs at least 5 points
+        if len(c) >= 5:
+            
+            #get paramters of the rotated bounding ellipse of contour
+            ((xc, yc), (d1, d2), angle) = cv2.fitEllipse(c)
+            
+            record.update(major_axis = float(max(d1, d2)/2), minor_axis = float(min(d1, d2)/2), center_x = float(xc), center_y = float(yc))
+        
+        # lack of enough points to fit circle
+        if len(c) >= 10:
+            
+            c_np = np.vstack(c).squeeze()
+            
+            record['curvature'] = float(ComputeCurvature(c_np[:, 0], c_np[:, 1]).fit(c_np[:, 0], c_np[:, 1]))
+    
+    return leaf_records
+
+
+
 # compute percentage as two decimals value
 def percentage(part, whole):
   
@@ -691,8 +1156,9 @@ def percentage(part, whole):
   return str(percentage)
 
 
-# convert image from RGB to LAB color space
-def image_BRG2LAB(image_file):
+# convert image from RGB to LAB color space, the 3D plot of the Lab values is saved in result_path
+def image_BRG2LAB(image_file, result_path):
+    import matplotlib.pyplot as plt
 
    # extarct path and name of the image file
     abs_path = os.path.abspath(image_file)
@@ -705,7 +1171,7 @@ def image_BRG2LAB(image_file):
     # get the image file name
     image_file_name = Path(image_file).name
     
-    print("Converting image {0} from RGB to LAB color space\n".format(str(image_file_name)))
+    logger.debug("Converting image %s from RGB to LAB color space", image_file_name)
     
     
     # load the input image 
@@ -839,11 +1305,11 @@ def circle_detection(image):
        
         if len(circles) < 2:
            
-            print("Only one circle was found!\n")
+            logger.debug("Only one circle was found!")
            
         else:
             
-            print("More than one circles were found!\n")
+            logger.debug("More than one circles were found!")
         
             idx_closest = 0
         
@@ -859,7 +1325,7 @@ def circle_detection(image):
 
         if idx_closest == 0:
 
-            print("Circle marker with radius = {} was detected!\n".format(circle_center_radius[idx_closest]))
+            logger.debug("Circle marker with radius = %s was detected!", circle_center_radius[idx_closest])
         
             '''
             # draw the circle in the output image, then draw a center
@@ -916,7 +1382,7 @@ def circle_detection(image):
     
     else:
         
-        print("No circle was found!\n")
+        logger.debug("No circle was found!")
         
         ROI_region = output
         
@@ -959,7 +1425,7 @@ def sticker_detect(img_ori):
 
         flag = False
     
-    print(flag)
+    logger.debug("%s", flag)
     
 
     # Store the coordinates of matched area in a numpy array 
@@ -998,6 +1464,7 @@ def sticker_detect(img_ori):
 
 # compute the size and shape info of the foreground
 def comp_external_contour(orig, thresh):
+    from scipy.spatial import distance as dist
     
 
     #find contours and get the external one
@@ -1018,7 +1485,7 @@ def comp_external_contour(orig, thresh):
     if len(contours) > merger_contour:
         
         #####################################################################################
-        print("Merging contours...\n")
+        logger.debug("Merging contours...")
         
         # using agglomerative clustering algorithm to group contours belonging to same object
         contours_list = [element for element in contours]
@@ -1043,7 +1510,7 @@ def comp_external_contour(orig, thresh):
     else:
         
         #####################################################################################
-        print("No need to merge contours...\n")
+        logger.debug("No need to merge contours...")
     
     
 
@@ -1094,7 +1561,7 @@ def comp_external_contour(orig, thresh):
                 # draw a green rectangle to visualize the bounding rect
                 roi = orig[y:y+h, x:x+w]
                 
-                print("ROI {} detected ...\n".format(index))
+                logger.debug("ROI %s detected ...", index)
                 #result_file = (result_path +  str(index) + file_extension)
                 #cv2.imwrite(result_file, roi)
                 
@@ -1146,13 +1613,13 @@ def comp_external_contour(orig, thresh):
                 '''
                 
                 area = cv2.contourArea(c)
-                print("Leaf area = {0:.2f}... \n".format(area))
+                logger.debug("Leaf area = %.2f...", area)
                 
                 
                 hull = cv2.convexHull(c)
                 hull_area = cv2.contourArea(hull)
                 solidity = float(area)/hull_area
-                print("solidity = {0:.2f}... \n".format(solidity))
+                logger.debug("solidity = %.2f...", solidity)
                 
                 
                 extLeft = tuple(c[c[:,:,0].argmin()][0])
@@ -1176,7 +1643,7 @@ def comp_external_contour(orig, thresh):
                 
                 longest_dimension = max(max_width, max_height)
 
-                print("Width and height are {0:.2f},{1:.2f}... \n".format(w, h))
+                logger.debug("Width and height are %.2f,%.2f...", w, h)
         
     
 
@@ -1218,6 +1685,7 @@ def RGB2FLOAT(color):
 
 # get color map from index
 def get_cmap(n, name = 'hsv'):
+    import matplotlib.pyplot as plt
     '''Returns a function that maps each index in 0, 1, ..., n-1 to a distinct 
     RGB color; the keyword argument name must be a standard mpl colormap name.'''
     return plt.get_cmap(name, n)
@@ -1227,81 +1695,153 @@ def get_cmap(n, name = 'hsv'):
     
 
 
-# cluster colors in the maksed image
-def color_region(image, mask, result_path, num_clusters):
+# bounding box (x, y, w, h) of the plant mask padded by margin pixels and clipped to the image, None if the mask is empty
+def plant_roi(mask, margin):
     
-    # read the image
-     #grab image width and height
-    (h, w) = image.shape[:2]
+    (x, y, w, h) = cv2.boundingRect(mask)
+    
+    if w == 0 or h == 0:
+        return None
+    
+    (img_height, img_width) = mask.shape[:2]
+    
+    (x0, y0) = (max(x - margin, 0), max(y - margin, 0))
+    
+    return (x0, y0, min(x + w + margin, img_width) - x0, min(y + h + margin, img_height) - y0)
 
-    #apply the mask to get the segmentation of plant
-    masked_image_ori = cv2.bitwise_and(image, image, mask = mask)
 
-    # convert to RGB
-    image_RGB = cv2.cvtColor(masked_image_ori, cv2.COLOR_BGR2RGB)
+# view of the ROI of an image, the full image if roi_box is None
+def roi_crop(image, roi_box):
+    
+    if roi_box is None:
+        return image
+    
+    (x, y, w, h) = roi_box
+    
+    return image[y:y+h, x:x+w]
 
-    # reshape the image to a 2D array of pixels and 3 color values (RGB)
-    pixel_values = image_RGB.reshape((-1, 3))
+
+# map an image computed on the ROI back to the full frame of shape, the other pixels are filled with the background value
+def roi_paste(image, roi_box, shape, background = 0):
+    
+    if roi_box is None:
+        return image
     
-    # convert to float
-    pixel_values = np.float32(pixel_values)
+    (x, y, w, h) = roi_box
+    
+    frame = np.full(tuple(shape[:2]) + image.shape[2:], background, dtype = image.dtype)
+    
+    frame[y:y+h, x:x+w] = image
+    
+    return frame
+
 
-    # define stopping criteria
-    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.2)
+# extract the foreground pixels of an image, return a compact (N, channels) array of pixel values and their flat indices in the mask
+# only the ROI is scanned if roi_box is given, the flat indices still refer to the full frame
+def foreground_pixels(image, mask, roi_box = None):
+    
+    flat_index = np.flatnonzero(roi_crop(mask, roi_box))
+    
+    n_channels = image.shape[2] if image.ndim == 3 else 1
+    
+    if roi_box is not None:
+        
+        (x, y, w, h) = roi_box
+        
+        # pixels of the ROI and the positions of the foreground pixels in the full frame, in the same row-major order
+        pixels = roi_crop(image, roi_box).reshape(-1, n_channels)[flat_index]
+        
+        flat_index = (flat_index // w + y) * mask.shape[1] + (flat_index % w + x)
+        
+        return pixels, flat_index
+    
+    pixels = image.reshape(-1, n_channels)[flat_index]
+    
+    return pixels, flat_index
 
-    # number of clusters (K)
-    compactness, labels, (centers) = cv2.kmeans(pixel_values, num_clusters, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS)
 
-    # convert back to 8 bit values
-    centers = np.uint8(centers)
+# scatter foreground pixel values back into a full frame image, the other pixels are filled with the background value
+def scatter_foreground(values, flat_index, shape, background = 0):
+    
+    frame = np.empty((shape[0]*shape[1],) + values.shape[1:], dtype = values.dtype)
+    
+    frame[...] = background
+    
+    frame[flat_index] = values
+    
+    return frame.reshape(tuple(shape[:2]) + values.shape[1:])
 
-    # flatten the labels array
-    labels_flat = labels.flatten()
 
-    # convert all pixels to the color of the centroids
-    clustered_image = centers[labels_flat]
 
-    # reshape back to the original image dimension
-    clustered_image = clustered_image.reshape(image_RGB.shape)
+# cluster colors in the maksed image, only the ROI is scanned if roi_box is given
+# masked image, clustered image and the image of each color cluster are only rendered and saved if debug is True, always in the full frame
+def color_region(image, mask, result_path, num_clusters, seed = None, debug = True, roi_box = None):
+    from sklearn.cluster import KMeans
+    
+    # read the image
+     #grab image width and height
+    (h, w) = image.shape[:2]
 
-    clustered_BGR = cv2.cvtColor(clustered_image, cv2.COLOR_RGB2BGR)
+    # keep only the foreground pixels, the background is excluded before clustering
+    (foreground_BGR, flat_index) = foreground_pixels(image[:, :, :3], mask, roi_box)
     
+    # convert to RGB
+    foreground_RGB = foreground_BGR[:, ::-1]
     
+    # compress the foreground pixels into unique colors and their counts
+    packed_colors = (foreground_RGB[:, 0].astype(np.uint32) << 16) | (foreground_RGB[:, 1].astype(np.uint32) << 8) | foreground_RGB[:, 2]
     
-    ####################################################################
+    (unique_packed, unique_index, unique_counts) = np.unique(packed_colors, return_inverse = True, return_counts = True)
+    
+    unique_colors = np.stack(((unique_packed >> 16) & 255, (unique_packed >> 8) & 255, unique_packed & 255), axis = 1).astype(np.float32)
+    
+    # one of the num_clusters clusters was used by the background, the rest are foreground color clusters
+    num_clusters = max(1, min(num_clusters - 1, len(unique_packed)))
+    
+    # cluster the unique colors weighted by their counts
+    kmeans = KMeans(n_clusters = num_clusters, n_init = 10, max_iter = 100, random_state = seed).fit(unique_colors, sample_weight = unique_counts)
+
+    # convert back to 8 bit values
+    centers = np.uint8(kmeans.cluster_centers_)
 
-    # render only one chosen cluster 
+    # broadcast the labels of unique colors back to the foreground pixels
+    labels_foreground = kmeans.labels_[unique_index.ravel()]
+    
+    
+    masked_image_ori = clustered_BGR = None
     
     clustered_levels = []
     
-    for cluster_ID in range(num_clusters):
+    if debug:
         
-        if RGB2HEX(centers[cluster_ID]) != '#000000':
+        #apply the mask to get the segmentation of plant
+        masked_image_ori = scatter_foreground(foreground_BGR, flat_index, (h, w))
         
-            print("Processing color cluster {}, value = {} ...\n".format(cluster_ID+1, RGB2HEX(centers[cluster_ID])))
-            
-            empty_image = np.zeros_like(image_RGB)
+        # convert all pixels to the color of the centroids, in BGR order for opencv format
+        centers_BGR = centers[:, ::-1]
+        
+        clustered_BGR = scatter_foreground(centers_BGR[labels_foreground], flat_index, (h, w))
+        
+        
+        ####################################################################
 
-            # convert to the shape of a vector of pixel values
-            empty_image = empty_image.reshape((-1, 3))
+        # render only one chosen cluster 
+        
+        for cluster_ID in range(num_clusters):
             
-            # assign cluster center values to the a vector of pixel values
-            empty_image[labels_flat == cluster_ID] = centers[cluster_ID]
-
-
-            # convert back to original shape
-            empty_image_reshape = empty_image.reshape(image_RGB.shape)
+            logger.debug("Processing color cluster %d, value = %s ...", cluster_ID+1, RGB2HEX(centers[cluster_ID]))
             
-            # convert RGB to BGR for opencv foramt
-            cluster_level_BRG = cv2.cvtColor(empty_image_reshape, cv2.COLOR_RGB2BGR)
+            # assign cluster center values to the pixels of the cluster
+            cluster_values = np.zeros_like(foreground_BGR)
+            cluster_values[labels_foreground == cluster_ID] = centers_BGR[cluster_ID]
+            
+            cluster_level_BRG = scatter_foreground(cluster_values, flat_index, (h, w))
             
             clustered_levels.append(cluster_level_BRG)
 
-            # save path
-            result_img_path = result_path + 'cluster_' + str(RGB2HEX(centers[cluster_ID])) + '.png'
-            
             # write output
-            cv2.imwrite(result_img_path, cluster_level_BRG)
+            if debug_artifact_enabled('clusters'):
+                write_image_output(cluster_level_BRG, result_path, 'cluster_', str(RGB2HEX(centers[cluster_ID])))
             
             
             ###########################################################
@@ -1314,56 +1854,35 @@ def color_region(image, mask, result_path, num_clusters):
             #write_image_output(A, result_path, 'cluster_' + str(cluster_ID+1), str(RGB2HEX(centers[cluster_ID])) + '_A', '.png')
             
             #write_image_output(B, result_path, 'cluster_' + str(cluster_ID+1), str(RGB2HEX(centers[cluster_ID])) + '_B', '.png')
-        
+            
         
     
 
 
     ####################################################################
-    counts = Counter(labels_flat)
-
+    # number of foreground pixels in each cluster
+    cluster_sizes = np.bincount(labels_foreground, minlength = num_clusters)
+    
     # sort to ensure correct color percentage
-    counts = dict(sorted(counts.items()))
+    counts = {cluster_ID: int(cluster_sizes[cluster_ID]) for cluster_ID in range(num_clusters) if cluster_sizes[cluster_ID] > 0}
     
-    center_colors = centers
-
     # We get ordered colors by iterating through the keys
-    ordered_colors = [center_colors[i] for i in counts.keys()]
-    
-    hex_colors = [RGB2HEX(ordered_colors[i]) for i in counts.keys()]
+    hex_colors = [RGB2HEX(centers[i]) for i in counts.keys()]
     
     #rgb_colors = [RGB2FLOAT(ordered_colors[i]) for i in counts.keys()]
 
-    #rgb_colors = [ordered_colors[i] for i in counts.keys()]
-    
-    rgb_colors = [np.array(ordered_colors[i]).reshape(1, 3) for i in counts.keys()]
-
-    index_bkg = [index for index in range(len(hex_colors)) if hex_colors[index] == '#000000']
-   
-    if len(index_bkg) > 0:
-        
-        #remove background color 
-        del hex_colors[index_bkg[0]]
-        del rgb_colors[index_bkg[0]]
-        
-        
-        # Using dictionary comprehension to find list 
-        # keys having value . 
-        delete = [key for key in counts if key == index_bkg[0]] 
-      
-        # delete the key 
-        for key in delete: del counts[key]
+    rgb_colors = [np.array(centers[i]).reshape(1, 3) for i in counts.keys()]
     
     
-    print("sorted hex_colors = {}\n".format(hex_colors))
-    print("sorted rgb_colors = {}\n".format(rgb_colors))
+    logger.debug("sorted hex_colors = %s", hex_colors)
+    logger.debug("sorted rgb_colors = %s", rgb_colors)
     
 
     ########################################################################
     #compute color cluster ratio in percentage
     list_counts = list(counts.values())
     
-    print("list_counts = {}\n".format(list_counts))
+    logger.debug("list_counts = %s", list_counts)
     
     color_ratio = []
 
@@ -1382,6 +1901,8 @@ def color_region(image, mask, result_path, num_clusters):
 
 # normalzie image
 def _normalise_image(image, *, image_cmap=None):
+    import matplotlib.pyplot as plt
+    from skimage import img_as_float
     image = img_as_float(image)
     if image.ndim == 2:
         if image_cmap is None:
@@ -1451,54 +1972,41 @@ def hex_mean_color(color_list):
 
 # convert from RGB to LAB space,
 # Convert it to LAB color space to access the luminous channel which is independent of colors.
-def RGB2LAB(image, mask):
-    
-    # Make backup image
-    image_rgb = image.copy()
-    
-    # apply object mask
-    masked_rgb = cv2.bitwise_and(image_rgb, image_rgb, mask = mask)
+def RGB2LAB(image, mask, roi_box = None):
     
-    # Convert color space to LAB space and extract L channel
-    (L, A, B) = cv2.split(cv2.cvtColor(masked_rgb, cv2.COLOR_BGR2LAB))
+    # get the foreground pixels of the object mask
+    (foreground_BGR, flat_index) = foreground_pixels(image[:, :, :3], mask, roi_box)
     
-
-    return masked_rgb, L, A, B
+    (h, w) = mask.shape[:2]
     
-
-
-#computation of color_difference index
-def color_diff_index(ref_color, rgb_colors):
+    masked_rgb = scatter_foreground(foreground_BGR, flat_index, (h, w))
     
-    #print(ref_color)
+    # black background pixels in LAB color space, (0, 128, 128) for 8 bit images
+    background_lab = cv2.cvtColor(np.zeros((1, 1, 3), dtype = np.uint8), cv2.COLOR_BGR2LAB)[0, 0]
     
-    #lab_colors = cv2.cvtColor(rgb_colors, cv2.COLOR_RGB2LAB)
+    # Convert color space of the foreground pixels to LAB space and extract L channel
+    if len(flat_index) > 0:
+        foreground_lab = cv2.cvtColor(foreground_BGR.reshape(-1, 1, 3), cv2.COLOR_BGR2LAB).reshape(-1, 3)
+    else:
+        foreground_lab = np.zeros((0, 3), dtype = np.uint8)
     
-    color_diff = []
+    (L, A, B) = [scatter_foreground(foreground_lab[:, i], flat_index, (h, w), background_lab[i]) for i in range(3)]
     
-    for index, value in enumerate(rgb_colors): 
-        
-        curr_color = rgb2lab(value)
-        
-        # color value from skimage rgb2lab: ranges of Lab values which are: L (0-100), a (-128-127), b (-128-127). 
-        # differnt from OpenCV cv2.COLOR_RGB2LAB, need scale to 0~255
-        curr_color_scaled = (curr_color + [155, 128, 128]) 
 
-        #color difference in CIE lab space
-        diff = deltaE_cie76(ref_color, curr_color_scaled)
-        
-        diff_value = float(diff)
+    return masked_rgb, L, A, B
+    
 
-        #diff = dist.euclidean(std_color_value[1].flatten(), checker_color_value[13].flatten())
-        
-        color_diff.append(diff_value)
-        
-        #print("current color value = {}, cluster index = {}, color difference = {}: \n".format(curr_color_scaled, index, diff)) 
+# color difference between the cluster colors given in skimage Lab and each reference color, all clusters and references in one call,
+# return matrix of shape (number of clusters, number of reference colors)
+def color_diff_index(ref_colors, color_lab, method = 'cie76'):
     
-    #color_diff_index = sum(color_diff) / len(color_diff)
+    # color value from skimage rgb2lab: ranges of Lab values which are: L (0-100), a (-128-127), b (-128-127). 
+    # differnt from OpenCV cv2.COLOR_RGB2LAB, need scale to 0~255
+    # the historical offset [155, 128, 128] is kept so that the color difference traits stay comparable with earlier results
+    color_lab_scaled = np.asarray(color_lab).reshape((-1, 3)) + [155, 128, 128]
     
-        
-    return color_diff
+    #color difference in CIE lab space
+    return color_metrics.delta_e_matrix(color_lab_scaled, ref_colors, method)
 
 
 # Max RGB filter 
@@ -1548,7 +2056,7 @@ def execute_script(cmd_line):
 
         process = subprocess.getoutput(cmd_line)
         
-        print(process)
+        logger.debug("%s", process)
         
         #process = subprocess.Popen(cmd_line, shell = True, stdout = subprocess.PIPE)
         #process.wait()
@@ -1556,552 +2064,1270 @@ def execute_script(cmd_line):
         
     except OSError:
         
-        print("Failed ...!\n")
+        logger.error("Failed ...!")
 
 
 
 
-# compute all the traits
-def extract_traits(image_file):
+# u2net model session of rembg, loaded once per process and reused for all images
+rembg_session = None
 
+rembg_session_lock = threading.Lock()
 
-    #gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    '''
-    abs_path = os.path.abspath(image_file)
+
+# get the u2net model session, create it at the first call
+def get_rembg_session(model_name = 'u2net'):
+    import onnxruntime as ort
+    from rembg.sessions import sessions_class
     
-    filename, file_extension = os.path.splitext(abs_path)
+    global rembg_session
     
-    base_name = os.path.splitext(os.path.basename(filename))[0]
+    with rembg_session_lock:
+        
+        if rembg_session is None:
+            
+            # the number of ONNX Runtime threads is set on this session only, 
+            # OMP_NUM_THREADS would also change the other OpenMP/BLAS users of the process
+            sess_opts = ort.SessionOptions()
+            
+            if args['ai_threads'] > 0:
+                sess_opts.intra_op_num_threads = args['ai_threads']
+            
+            logger.info("Loading %s AI model session...", model_name)
+            
+            # the session class is created directly, rembg new_session does not accept session options in all versions
+            session_class = [sc for sc in sessions_class if sc.name() == model_name]
+            
+            if not session_class:
+                raise ValueError("Unknown rembg model {}".format(model_name))
+            
+            rembg_session = session_class[0](model_name, sess_opts)
     
-    '''
+    return rembg_session
 
 
-   
-    
-    # make the folder to store the results
-    #current_path = abs_path + '/'
-    
-    #print("Computing traits for image : {0}\n".format(str(image_file_name)))
+# load the u2net model and run it once on a small image, so the first plant image does not pay for the initialization
+def warm_up_rembg_session():
+    from rembg import remove
     
+    remove(np.zeros((64, 64, 3), dtype = np.uint8), session = get_rembg_session())
+
 
+
+# remove image background using u2net AI model, 
+# if ai_size > 0, the model runs on a copy resized to ai_size pixels along the longer side and the alpha mask is upsampled to full resolution
+def remove_background(image, ai_size = 0):
+    from rembg import remove
     
-    #########################################################################################
-    # check color brightness
-    #(b_bright, b_value) = isbright(image_file)
+    (img_height, img_width) = image.shape[:2]
     
-    # initilize parameters
-    area = solidity = max_width = max_height = avg_curv = n_leaves = diameter_circle = compactness = longest_dimension = 0
+    if ai_size <= 0 or max(img_height, img_width) <= ai_size:
         
+        return remove(image, session = get_rembg_session()).copy()
+    
+    
+    scale = ai_size / float(max(img_height, img_width))
+    
+    image_small = cv2.resize(image, (max(1, int(round(img_width*scale))), max(1, int(round(img_height*scale)))), interpolation = cv2.INTER_AREA)
+    
+    # get only the foreground probability mask from the model 
+    alpha_small = np.asarray(remove(image_small, session = get_rembg_session(), only_mask = True))
+    
+    if alpha_small.ndim == 3:
+        alpha_small = alpha_small[:, :, 0]
+    
+    # upsample the alpha mask back to the full resolution
+    alpha = cv2.resize(alpha_small, (img_width, img_height), interpolation = cv2.INTER_LINEAR)
+    
+    # cut out the foreground the same way as rembg, background pixels become transparent black
+    alpha_weight = alpha.astype(np.float32)[:, :, np.newaxis] / 255.0
+    
+    cutout = np.round(image[:, :, :3].astype(np.float32) * alpha_weight).astype(np.uint8)
+    
+    return np.dstack((cutout, alpha))
 
-    ################################################################################
-    # load image data
-    image = cv2.imread(image_file)
+
+
+# reset the peak resident set size of the process, only supported on Linux
+def peak_rss_reset():
+    
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+# peak resident set size of the process in MB since the last reset
+def peak_rss_mb():
+    
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    
+    # peak since the process started, in bytes on macOS and in kilobytes on Linux
+    import resource
+    
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    return peak / MBFACTOR if sys.platform == 'darwin' else peak / 1024.0
+
+
+# call the function and append its wall time, CPU time and peak memory to the profile records
+# CPU time and memory are measured for the whole process, so they include other threads in thread pool mode
+def profile_call(records, stage, function, *function_args):
+    
+    peak_rss_reset()
+    
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    
+    result = function(*function_args)
     
-    # make backup image
-    orig = image.copy()
+    records.append({'stage': stage, 'wall_s': time.perf_counter() - wall_start, 'cpu_s': time.process_time() - cpu_start, 'peak_rss_mb': peak_rss_mb()})
+    
+    return result
+
+
+
+###################################################################################################
+# pipeline stages of extract_traits
+# each stage reads its declared inputs from the image state dict and stores its declared outputs in it,
+# a stage returns False to stop the pipeline, e.g. when no plant object was found
+
+
+# load image data
+def stage_load(state):
+    
+    image = cv2.imread(state['image_file'])
     
     # get the dimension of the image
-    img_height, img_width, img_channels = orig.shape
+    img_height, img_width, img_channels = image.shape
+    
+    logger.debug("Plant object segmentation using automatic color clustering method...")
+    
+    logger.debug("Image file dimension: %d X %d, channels: %d", img_height, img_width, img_channels)
+    
+    state['orig'] = image
+
 
-    #source_image = cv2.cvtColor(orig, cv2.COLOR_BGR2RGB)
 
-    #QR_data = 0
+#Plant region detection (defined as ROI_region)
+def stage_ai_removal(state):
     
-    ################################################################################
-    # output image file info
-    if image is not None:
+    if AI_model == 1:
         
-        print("Plant object segmentation using automatic color clustering method... \n")
+        logger.debug("Use u2net AI model to help segmentation...")
         
-        print("Image file dimension: {} X {}, channels: {}\n".format(img_height, img_width, img_channels))
+        state['roi_image'] = remove_background(state['orig'], args['ai_size'])
+    else:
         
+        logger.debug("Not use u2net AI model to help segmentation...")
         
-    
-    '''
-    ##################################################################################
-    # circle marker detection
-    (diameter_circle, ROI_region, circle_detection_img) = circle_detection(orig) 
+        state['roi_image'] = state['orig'].copy()
+
 
-    # save result
-    result_file = (result_path + base_name + '_circle_template' + file_extension)
-    cv2.imwrite(result_file, circle_detection_img)
-    
-    
-    #orig = sticker_crop_img.copy()
-    result_img_path = result_path + 'ROI_region.png'
-    cv2.imwrite(result_img_path, ROI_region)
-    '''
-    ##########################################################################
-    #Plant region detection (defined as ROI_region)
 
-    #roi_image = ROI_region.copy()
+#color clustering based plant object segmentation, return plant object mask
+def stage_segmentation(state):
     
-    ROI_region = orig.copy()
+    thresh = color_cluster_seg(state['roi_image'], args_colorspace, args_channels, 2, args['seg_engine'], args['sample_size'], args['seed'], args['seg_scale'])
     
-    if AI_model == 1:
+    state['thresh_seg'] = thresh
+    
+    if cv2.countNonZero(thresh) == 0:
         
-        print("Use u2net AI model to help segmentation...\n")
+        logger.warning("Image is black, no plant object was found")
         
-        roi_image = remove(ROI_region).copy()
+        return False
+    
+    logger.debug("Colored image")
+
+
+
+# padded bounding box of the plant, the later stages only process this region
+# the margin keeps the border exclusion and the min_distance window of the watershed peak detection inside the ROI, 
+# so the results are the same as on the full frame
+def stage_roi(state):
+    
+    if args['roi'] == 1:
+        state['roi_box'] = plant_roi(state['thresh_seg'], min_distance_value + 2)
     else:
+        state['roi_box'] = None
+
+
+
+# color clustering of masked image using pre-defined color cluster value by user, colors are sorted by ratio in descending order
+def stage_color_region(state):
+    
+    logger.debug("number of cluster: %s", args_num_clusters)
+    
+    (rgb_colors, counts, hex_colors, color_ratio, masked_image_ori, clustered_BGR, clustered_levels) = color_region(state['orig'], state['thresh_seg'].copy(), state['result_path'], args_num_clusters, args['seed'], debug_artifact_enabled('masked_roi', 'clustered', 'clusters', 'lab_channels'), state['roi_box'])
+    
+    list_counts = list(counts.values())
+    
+    color_ratio = []
+    
+    for value_counts, value_hex in zip(list_counts, hex_colors):
+        
+        color_ratio.append(percentage(value_counts, np.sum(list_counts)))
+    
+    sorted_idx_ratio = np.argsort(color_ratio)
+    
+    #reverse the order from accending to descending
+    sorted_idx_ratio = sorted_idx_ratio[::-1]
+    
+    #sort all lists according to sorted_idx_ratio order
+    rgb_colors[:] = [rgb_colors[i] for i in sorted_idx_ratio]
+    color_ratio[:] = [color_ratio[i] for i in sorted_idx_ratio]
+    hex_colors[:] = [hex_colors[i] for i in sorted_idx_ratio]
+    
+    # colorspace teransformation from RGB to LAB of all clusters, skimage scale L (0 ~ 100), a and b (-128 ~ 127)
+    color_lab = color_metrics.rgb_to_lab(rgb_colors)
+    
+    # OpenCV 8-bit scale of the palette colors
+    color_lab_scaled = color_metrics.lab_to_opencv(color_lab)
+    
+    # label all clusters in one call
+    color_names = COLOR_LABELER.label_colors(color_lab_scaled)
+    
+    for (ratio_value, color_value, curr_color_lab, curr_color_lab_scaled, color_name) in zip(color_ratio, rgb_colors, color_lab, color_lab_scaled, color_names):
         
-        print("Not use u2net AI model to help segmentation...\n")
+        logger.debug('color_value = %s, curr_color_lab_scaled = %s', color_value, curr_color_lab_scaled)
         
-        roi_image = orig.copy()
+        logger.debug('Percentage = %s, rgb_color = %s, lab_color = %s, color_name = %s', ratio_value, color_value.reshape((1,3)), curr_color_lab, color_name)
+    
+    logger.debug("color_ratio = %s", color_ratio)
     
+    state.update(rgb_colors = rgb_colors, counts = counts, hex_colors = hex_colors, color_ratio = color_ratio,
+                 masked_image_ori = masked_image_ori, clustered_BGR = clustered_BGR, clustered_levels = clustered_levels, color_lab = color_lab)
+
+
 
+#compute external contour, shape info, the mask is updated with the merged external contours
+def stage_contour(state):
     
-    ###################################################################################
-    # PhotoRoom Remove Background API
+    (thresh_combined, trait_img, area, solidity, max_width, max_height, longest_dimension) = comp_external_contour(state['orig'].copy(), state['thresh_seg'].copy())
+    
+    compactness = min(max_width,max_height)/max(max_width,max_height)
+    
+    state.update(thresh = thresh_combined, trait_img = trait_img, area = area, solidity = solidity, max_width = max_width, max_height = max_height,
+                 longest_dimension = longest_dimension, compactness = compactness)
+
+
+
+# compute the distance between the reference color value and the color of each cluster in CIE lab space
+def stage_color_diff(state):
     
-    # AI pre-trained model to segment plant object, test function
-    #roi_image = remove(ROI_region).copy()
+    # reference colors, compared with the scaled Lab values of the clusters as given
+    ref_color_list = [(157, 188, 64)]
     
+    # one row per cluster, one column per reference color
+    color_diff_matrix = color_diff_index(ref_color_list, state['color_lab'])
     
+    logger.debug('color_diff_index_value = %s', color_diff_matrix)
     
-    #orig = roi_image.copy()
+    # values are listed by reference color, then by cluster
+    state['color_diff_list'] = color_diff_matrix.T.ravel().tolist()
 
-    '''
-    # extract alpha channel
-    alpha = roi_image[:, :, 3]
 
-    # threshold alpha channel to get mask from alpha channel
-    roi_mask = cv2.threshold(alpha, 0, 255, cv2.THRESH_BINARY)[1]
+
+# Euclidean distance transform of the mask in the ROI, shared by the watershed and the medial axis skeleton
+def stage_distance(state):
+    from scipy import ndimage
     
-   
-    #apply the mask to get the segmentation of plant
-    #masked_orig = cv2.bitwise_and(image.copy(), image.copy(), mask = roi_mask)
+    state['distance'] = ndimage.distance_transform_edt(roi_crop(state['thresh'], state['roi_box']))
+
+
+
+# accquire skeleton of segmentation mask, the medial axis engine reuses the distance transform if the watershed stage already needed it, 
+# otherwise skeleton_bw computes it, the other engines do not need it
+def stage_skeleton(state):
+    from skimage import img_as_ubyte
     
+    image_skeleton, skeleton = skeleton_bw(roi_crop(state['thresh'], state['roi_box']), args['skeleton_engine'], state.get('distance'))
     
-    #define result path for labeled images
-    result_img_path = result_path + 'roi_masked.png'
-    cv2.imwrite(result_img_path, roi_mask)
-    '''
+    state['image_skeleton'] = roi_paste(img_as_ubyte(image_skeleton), state['roi_box'], state['thresh'].shape)
+
+
+
+#watershed based leaf area segmentaiton, the label image covers the ROI only
+def stage_watershed(state):
     
+    logger.debug("min_distance_value = %s", min_distance_value)
     
-    ######################################################################################
-    #orig = roi_image.copy()
+    labels = watershed_seg(roi_crop(state['orig'], state['roi_box']), roi_crop(state['thresh'], state['roi_box']), min_distance_value, state['distance'])
     
-
-    #color clustering based plant object segmentation, return plant object mask
-    thresh = color_cluster_seg(roi_image, args_colorspace, args_channels, 2)
+    #Map component labels to hue val
+    label_hue = np.uint8(128*labels/np.max(labels))
+    blank_ch = 255*np.ones_like(label_hue)
+    labeled_img = cv2.merge([label_hue, blank_ch, blank_ch])
     
+    # cvt to BGR for display
+    labeled_img = cv2.cvtColor(labeled_img, cv2.COLOR_HSV2BGR)
     
+    labeled_img[label_hue==0] = 0
     
+    labeled_img = roi_paste(labeled_img, state['roi_box'], state['orig'].shape)
     
-    # adjust mask
+    n_leaves = int(len(np.unique(labels)))
     
-    #apply the mask to get the segmentation of plant
-    #masked_image_ori = cv2.bitwise_and(image, image, mask = thresh)
+    logger.debug('number of leaves = %d', n_leaves)
     
-    #mask_adjusted = remove(masked_image_ori.copy(), only_mask = True)
+    state.update(labels = labels, labeled_img = labeled_img, n_leaves = n_leaves)
 
-    #mask_adjusted = cv2.threshold(mask_adjusted, 128, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
 
-    #result_img_path = result_path + 'mask_adjusted.png'
-    #cv2.imwrite(result_img_path, mask_adjusted)
 
-    #result_img_path = result_path + 'thresh.png'
-    #cv2.imwrite(result_img_path, thresh)
+# traits of individual leaves
+def stage_leaf_traits(state):
     
+    # leaf coordinates in the full frame
+    offset = (0, 0) if state['roi_box'] is None else state['roi_box'][:2]
+    
+    state['leaf_records'] = leaf_traits(state['labels'], offset)
+
+
+
+# name: (inputs, outputs, function), listed in execution order, every stage comes after the stages producing its inputs
+PIPELINE_STAGES = OrderedDict([
+    ('load',            (['image_file'], ['orig'], stage_load)),
+    ('ai_removal',      (['orig'], ['roi_image'], stage_ai_removal)),
+    ('segmentation',    (['roi_image'], ['thresh_seg'], stage_segmentation)),
+    ('roi',             (['thresh_seg'], ['roi_box'], stage_roi)),
+    ('color_region',    (['orig', 'thresh_seg', 'roi_box', 'result_path'], ['rgb_colors', 'counts', 'hex_colors', 'color_ratio', 'masked_image_ori', 'clustered_BGR', 'clustered_levels', 'color_lab'], stage_color_region)),
+    ('contour',         (['orig', 'thresh_seg'], ['thresh', 'trait_img', 'area', 'solidity', 'max_width', 'max_height', 'longest_dimension', 'compactness'], stage_contour)),
+    ('color_diff',      (['color_lab'], ['color_diff_list'], stage_color_diff)),
+    ('distance',        (['thresh', 'roi_box'], ['distance'], stage_distance)),
+    ('skeleton',        (['thresh', 'roi_box'], ['image_skeleton'], stage_skeleton)),
+    ('watershed',       (['orig', 'thresh', 'roi_box', 'distance'], ['labels', 'labeled_img', 'n_leaves'], stage_watershed)),
+    ('leaf_traits',     (['labels', 'roi_box'], ['leaf_records'], stage_leaf_traits)),
+])
 
+# values of the image state dict if the stage producing them was not executed or the pipeline was stopped
+PIPELINE_DEFAULTS = {'area': 0, 'solidity': 0, 'max_width': 0, 'max_height': 0, 'compactness': 0, 'longest_dimension': 0, 'n_leaves': 0,
+                     'hex_colors': [0, 0, 0], 'color_ratio': [0, 0, 0], 'color_diff_list': [0, 0, 0], 'leaf_records': []}
+
+# pipeline outputs of each trait which can be selected with --traits
+TRAIT_OUTPUTS = OrderedDict([
+    ('leaf_area',           ['area']),
+    ('solidity',            ['solidity']),
+    ('max_width',           ['max_width']),
+    ('max_height',          ['max_height']),
+    ('compactness',         ['compactness']),
+    ('longest_dimension',   ['longest_dimension']),
+    ('color_hex',           ['hex_colors']),
+    ('color_ratio',         ['color_ratio']),
+    ('color_difference',    ['color_diff_list']),
+    ('leaves',              ['n_leaves']),
+])
+
+selected_traits = set(TRAIT_OUTPUTS)
+
+
+# names of the stages needed to compute the requested outputs, in execution order, None requests all outputs
+def pipeline_stages(outputs = None):
     
-    if cv2.countNonZero(thresh) == 0:
-        
-        print("Image is black")
+    if outputs is None:
+        return list(PIPELINE_STAGES)
+    
+    producer = {output: name for name, (inputs, stage_outputs, function) in PIPELINE_STAGES.items() for output in stage_outputs}
+    
+    unknown = [output for output in outputs if output not in producer]
+    
+    if unknown:
+        raise ValueError("No pipeline stage computes {}".format(', '.join(unknown)))
+    
+    # walk back from the requested outputs to the stages producing the inputs
+    needed = set()
+    
+    pending = [producer[output] for output in outputs]
+    
+    while pending:
         
-        area=solidity=max_width=max_height=n_leaves=0
+        name = pending.pop()
         
-        color_ratio = hex_colors = color_diff_list = [0,0,0]
+        if name not in needed:
+            
+            needed.add(name)
+            
+            pending.extend(producer[value] for value in PIPELINE_STAGES[name][0] if value in producer)
+    
+    return [name for name in PIPELINE_STAGES if name in needed]
 
+
+# pipeline outputs needed for the selected traits and debug artifacts
+def requested_outputs():
+    
+    outputs = [output for trait in selected_traits for output in TRAIT_OUTPUTS[trait]]
+    
+    outputs += [output for artifact in debug_artifacts for output in DEBUG_ARTIFACT_OUTPUTS[artifact]]
+    
+    # the traits of each leaf are only saved in the Parquet leaf table
+    if 'leaves' in selected_traits and args['parquet'] == 1:
+        outputs.append('leaf_records')
+    
+    return outputs
+
+
+
+# compute the traits, only the stages needed for the requested outputs are executed, return the image state dict
+# if a profile list is given, the cost of every executed stage is appended to it
+def extract_traits(image_file, result_path, outputs = None, profile = None):
+    
+    # initilize parameters
+    state = {name: (list(value) if isinstance(value, list) else value) for name, value in PIPELINE_DEFAULTS.items()}
+    
+    state.update(image_file = image_file, result_path = result_path)
+    
+    for name in pipeline_stages(outputs):
         
-    else:
-        
-        print("Colored image")
-        
-        ##########################################################################################################
-        # color clustering using pre-defined color cluster value by user
-        
-        print("number of cluster: {}\n".format(args_num_clusters))
-        
-        #color clustering of masked image
-        (rgb_colors, counts, hex_colors, color_ratio, masked_image_ori, clustered_BGR, clustered_levels) = color_region(ROI_region, thresh.copy(), result_path, args_num_clusters)
+        (inputs, stage_outputs, function) = PIPELINE_STAGES[name]
         
+        if profile is None:
+            result = function(state)
+        else:
+            result = profile_call(profile, name, function, state)
         
-        #result_img_path = result_path + 'thresh_color_region.png'
-        #cv2.imwrite(result_img_path, thresh)
+        if result is False:
+            break
+    
+    return state
+    
 
-        
-        ###########################################################################################################
-         #compute external contour, shape info  
-        (thresh_combined, trait_img, area, solidity, max_width, max_height, longest_dimension) = comp_external_contour(ROI_region, thresh.copy())
 
-        compactness = min(max_width,max_height)/max(max_width,max_height)
-        
+# Automatically generate result folder for each individual images
+def generate_output_path(input_image):
+    
+    if input_image is not None:
         
-        # update mask
+        # get file information
+        (file_path, filename, basename) = get_file_info(input_image)
+
+        logger.info("Processing image %s ...", input_image)
         
-        thresh = thresh_combined
+        # output folder path
+        if (args['output_path']):
+            output_path = args['output_path']
+        else:
+            mkpath = os.path.dirname(file_path) + '/' + basename
+            mkdir(mkpath)
+            output_path = mkpath + '/'
         
-      
+        logger.debug("Output path %s ...", output_path)
         
-        #print("hex_colors = {}\n".format(hex_colors))
+    else:
+        logger.error("Input image was None...")
         
+        sys.exit(1)
 
-        #result_img_path = result_path + 'thresh_comp_external_contour.png'
-        #cv2.imwrite(result_img_path, thresh)
+
+    return filename, basename, output_path
+
+
+
+
+# write one image file and check the saved file, 
+# the image is downscaled by preview_scale first, binary images stay binary so that thin lines of masks and skeletons are kept
+def save_image(result_file, imagearray, params = (), preview_scale = 1.0, binary = False):
+    
+    if preview_scale < 1.0:
+        
+        (img_height, img_width) = imagearray.shape[:2]
         
+        preview_size = (max(1, int(round(img_width*preview_scale))), max(1, int(round(img_height*preview_scale))))
         
+        imagearray = cv2.resize(imagearray, preview_size, interpolation = cv2.INTER_AREA)
         
-        # color canalysis
-        #print("hex_colors = {} {}\n".format(hex_colors, type(hex_colors)))
+        if binary:
+            imagearray = np.where(imagearray > 0, 255, 0).astype(np.uint8)
+    
+    cv2.imwrite(result_file, imagearray, list(params))
+    
+    # check saved file
+    if os.path.exists(result_file):
+        logger.debug("Result file was saved at %s", result_file)
+
+    else:
+        logger.warning("Result file %s writing failed!", result_file)
+
+
+
+# background writer of result images, encoding and disk I/O run in writer threads off the compute path,
+# cv2.imwrite releases the GIL so the threads overlap with the image processing
+class AsyncImageWriter:
+    
+    def __init__(self, n_threads = 2, max_queued = 16):
+        """ Start the writer threads, at most max_queued tasks are waiting so that pending images do not pile up in memory """
+        self.tasks = queue.Queue(maxsize = max_queued)
         
-        list_counts = list(counts.values())
+        # number of failed tasks, counted by all writer threads
+        self.n_failed = 0
         
-        #list_hex_colors = list(hex_colors)
+        self.failed_lock = threading.Lock()
         
-        #print(type(list_counts))
+        self.closed = False
         
-        color_ratio = []
+        self.threads = [threading.Thread(target = self.run, daemon = True) for i in range(max(1, n_threads))]
         
-        for value_counts, value_hex in zip(list_counts, hex_colors):
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        """ Execute queued tasks until the stop signal None was received """
+        while True:
             
-            #print(percentage(value, np.sum(list_counts)))
+            task = self.tasks.get()
             
-            color_ratio.append(percentage(value_counts, np.sum(list_counts)))
+            try:
+                if task is None:
+                    return
+                
+                (function, function_args) = task
+                
+                function(*function_args)
             
-            #print("value_hex = {0}".format(value_hex))
+            except Exception as e:
+                with self.failed_lock:
+                    self.n_failed += 1
+                logger.error("Failed to write result file: %s", e)
             
-            #value_hex.append(value_hex)
+            finally:
+                self.tasks.task_done()
+
+    def submit(self, function, *function_args):
+        """ Queue one task, blocks while the queue is full, the arguments must not be modified afterwards """
+        self.tasks.put((function, function_args))
+
+    def imwrite(self, result_file, imagearray, *save_args):
+        self.submit(save_image, result_file, imagearray, *save_args)
+
+    def flush(self):
+        """ Wait until all queued tasks were done """
+        self.tasks.join()
+
+    def close(self):
+        """ Finish all queued tasks and stop the writer threads """
+        if self.closed:
+            return
         
-            
-        #color_ratio_rec.append(color_ratio)
-        #color_value_rec.append(hex_colors)
+        self.closed = True
         
-        #print(rgb_colors)
-        #print(color_ratio)
+        for thread in self.threads:
+            self.tasks.put(None)
         
-        sorted_idx_ratio = np.argsort(color_ratio)
+        for thread in self.threads:
+            thread.join()
+        
+        if self.n_failed > 0:
+            logger.warning("%d result files could not be written", self.n_failed)
 
-        #reverse the order from accending to descending
-        sorted_idx_ratio = sorted_idx_ratio[::-1]
 
 
-        #sort all lists according to sorted_idx_ratio order
-        rgb_colors[:] = [rgb_colors[i] for i in sorted_idx_ratio] 
-        color_ratio[:] = [color_ratio[i] for i in sorted_idx_ratio]
-        hex_colors[:] = [hex_colors[i] for i in sorted_idx_ratio]
-        
-        color_name_cluster = []
-        ratio_color = []
+image_writer = None
 
-        cl = ColorLabeler()
-        
-        for index, (ratio_value, color_value, color_hex) in enumerate(zip(color_ratio, rgb_colors, hex_colors)): 
+image_writer_lock = threading.Lock()
+
+
+# get the result image writer of the current process, create it at the first call
+def get_image_writer():
+    
+    global image_writer
+    
+    with image_writer_lock:
         
-            # validation test color value
-            #Skimage rgb2lab outputs 0≤L≤100, −127≤a≤127, −127≤b≤127 . The values are then converted to the destination data type:
-            # To convert to opencv (0~255): 8-bit images: L←L∗255/100,a←a+128,b←b+128
-            
-            #curr_color_lab = rgb2lab([157/255.0, 188/255.0, 64/255.0])
-            
-            # color convertion between opencv lab data range and Skimage rgb2lab data range
-            
-            #print(type(color_value))
-            
-            #print((color_value.shape))
-            color_value_reshape = color_value.reshape((1,3))
-            
-            color_value_float = np.asarray([color_value_reshape[:, 0]/255.0, color_value_reshape[:,1]/255.0, color_value_reshape[:,2]/255.0])
-            
-            # colorspace teransformation from RGB to LAB 
-            curr_color_lab = rgb2lab(color_value_float.flatten())
-            
-            # +128 avoid the negative numbers when convert the image data to opencv format 
-            curr_color_lab_scaled = np.asarray([curr_color_lab[0]*255/100.0, curr_color_lab[1] + 128.0, curr_color_lab[2] + 128.0])
+        if image_writer is None:
             
+            image_writer = AsyncImageWriter(args['writer_threads'], args['writer_queue'])
             
-            print('color_value = {0}, curr_color_lab_scaled = {1}\n'.format(color_value, curr_color_lab_scaled))
-            
-            color_name = cl.label_c(curr_color_lab_scaled.flatten())
-            
-            print('Percentage = {0}, rgb_color = {1}, lab_color = {2}, color_name = {3}\n'.format(ratio_value, color_value_reshape, curr_color_lab, color_name))
-            
-            color_name_cluster.append(color_name)
-            
-            #ratio_color.append(str(color_name) + ":  "  + str("{:.2f}".format(float(ratio_value)*100) + "%"))
-            
-            ratio_color.append(str("{:.0f}".format(float(ratio_value)*100) + "%") + "; RGB:[" + "{:.2f}".format(float(color_value_reshape[:,0]/255.0)) + "," + "{:.2f}".format(float(color_value_reshape[:,1]/255.0)) + "," + "{:.2f}".format(float(color_value_reshape[:,2]/255.0)) + "]")
-            
-           
+            # worker processes exit without calling atexit handlers, multiprocessing finalizers also run there
+            multiprocessing.util.Finalize(image_writer, image_writer.close, exitpriority = 10)
+    
+    return image_writer
+
+
+# write all queued result images and stop the writer threads
+def close_image_writer():
+    
+    global image_writer
+    
+    with image_writer_lock:
         
-        print("color_ratio = {}\n".format(color_ratio))
-        '''
-        #####################################################################
-        if args["debug"] == 1:
-            
-            # save segmentation result
-            #result_file = (result_path + base_name + '_excontour' + file_extension)
-            result_file = (result_path + base_name + '_excontour.png')
-            #print(filename)
-            cv2.imwrite(result_file, trait_img)
-            
-            #draw pie chart of color distributation
-            fig = plt.figure(figsize = (8, 6))
-            #plt.pie(counts.values(), labels = hex_colors, colors = hex_colors)
-            
-            
-            plt.pie(counts.values(), labels = ratio_color, colors = hex_colors)
+        if image_writer is not None:
+            image_writer.close()
+            image_writer = None
+
+
+
+# names of the debug result images, selected with --debug_artifacts
+DEBUG_ARTIFACTS = ['mask', 'plant_region', 'excontour', 'skeleton', 'masked_roi', 'clustered', 'clusters', 'lab_channels', 'pie']
+
+debug_artifacts = set()
+
+
+# pipeline outputs needed by each debug artifact
+DEBUG_ARTIFACT_OUTPUTS = {'mask': ['thresh'], 'plant_region': ['roi_image'], 'excontour': ['trait_img'], 'skeleton': ['image_skeleton'], 
+                          'masked_roi': ['masked_image_ori'], 'clustered': ['clustered_BGR'], 'clusters': ['clustered_levels'], 
+                          'lab_channels': ['roi_image', 'thresh', 'clustered_BGR'], 'pie': ['counts', 'color_ratio', 'hex_colors']}
+
+
+# parse comma separated names, 'all' selects every choice
+def parse_selection(name_list, choices, kind):
+    
+    names = {name.strip() for name in name_list.split(',') if name.strip()}
+    
+    if 'all' in names:
+        return set(choices)
+    
+    unknown = names - set(choices)
+    
+    if unknown:
+        raise ValueError("Unknown {} {}, choose from: all, {}".format(kind, ', '.join(sorted(unknown)), ', '.join(choices)))
+    
+    return names
+
+
+# parse comma separated debug artifact names, 'all' selects every artifact
+def parse_debug_artifacts(artifact_list):
+    
+    return parse_selection(artifact_list, DEBUG_ARTIFACTS, 'debug artifacts')
+
+
+# check whether any of the named debug artifacts should be saved
+def debug_artifact_enabled(*names):
+    
+    return any(name in debug_artifacts for name in names)
+
+
+# file extension and OpenCV encoding parameters of debug images,
+# kind is 'mask' for binary images, 'channel' for gray level images and 'overlay' for color images
+def debug_image_encoding(kind):
+    
+    if kind == 'overlay' and args['overlay_format'] == 'jpg':
+        return '.jpg', [cv2.IMWRITE_JPEG_QUALITY, args['quality']]
+    
+    if kind == 'overlay' and args['overlay_format'] == 'webp':
+        return '.webp', [cv2.IMWRITE_WEBP_QUALITY, args['quality']]
+    
+    params = [cv2.IMWRITE_PNG_COMPRESSION, args['png_compression']]
+    
+    # one bit per pixel
+    if kind == 'mask' and args['bilevel_mask'] == 1:
+        params += [cv2.IMWRITE_PNG_BILEVEL, 1]
+    
+    return '.png', params
+
+
+
+# save result files with the encoding profile of the image kind, the image is written by the background writer
+def write_image_output(imagearray, result_path, base_name, addition, kind = 'overlay'):
+    
+    if imagearray is None:
+        return
+    
+    (ext, params) = debug_image_encoding(kind)
+    
+    # save segmentation result
+    result_file = (result_path + base_name + addition + ext)
+    
+    #print(result_file)
+    
+    get_image_writer().imwrite(result_file, imagearray, params, args['preview_scale'], kind == 'mask')
+    
+
 
-            #define result path for labeled images
-            result_img_path = result_path + 'pie_color.png'
-            plt.savefig(result_img_path)
-        '''
-        #######################################################################
+
+
+# parameters which change the computed traits, part of the result cache key
+CACHE_PARAMETERS = ['color_space', 'channels', 'num_clusters', 'min_size', 'max_size', 'min_dist', 'AI', 'merger_contour', 
+                    'ai_size', 'seg_engine', 'sample_size', 'seed', 'seg_scale', 'skeleton_engine', 'debug', 
+                    'debug_artifacts', 'overlay_format', 'quality', 'png_compression', 'bilevel_mask', 'preview_scale', 'traits', 'parquet']
+
+
+# source files of the trait computation, part of the code version of the result cache
+CODE_VERSION_FILES = ['smart_release.py', 'utils.py', 'color_metrics.py', 'skeleton_kernels.py']
+
+
+# on-disk cache of image traits, keyed by image content hash, effective parameters and code version
+class ResultCache:
+    
+    def __init__(self, cache_path, max_entries = 10000):
+        """ Initialize cache folder and size limit """
+        self.cache_path = os.path.join(cache_path, '')
+        self.max_entries = max_entries
+        self.code_version = None
+        
+        os.makedirs(self.cache_path, exist_ok = True)
+
+    def get_code_version(self):
+        """ hash of the trait computation source code, so that changed code invalidates old results """
+        if self.code_version is None:
+            h = hashlib.sha1()
+            for source_file in CODE_VERSION_FILES:
+                with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), source_file), 'rb') as f:
+                    h.update(f.read())
+            self.code_version = h.hexdigest()
+        return self.code_version
+
+    def key(self, image_file, parameters):
+        """ cache key of one image file """
+        h = hashlib.sha1()
         
-        # get reference color from selected color checker
-        #ref_color = rgb2lab(np.uint8(np.asarray([[rgb_colors_sticker[0]]])))
+        with open(image_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
         
-        ####################################################
-        # compute the distance between the current L*a*b* color value in color checker and the mean of the plant surface image in CIE lab space
+        h.update(json.dumps({p: parameters.get(p) for p in CACHE_PARAMETERS}, sort_keys = True).encode())
+        h.update(self.get_code_version().encode())
         
-        #print("Detected color checker value in lab: skin = {} foliage = {} purple = {}\n".format(checker_color_value[13], checker_color_value[15], checker_color_value[8]))
+        return h.hexdigest()
 
-        '''
-        if len(green_checker_idx) > 0:
+    def get(self, key):
+        """ return the cached traits, or None if the key is not cached """
+        entry_file = self.cache_path + key + '.json'
         
-            ref_color_list = checker_color_value[green_checker_idx[0]]
-            
-        else:
-            ref_color_list = [(157, 188, 64)]
-        '''
+        try:
+            with open(entry_file, 'r') as f:
+                row = json.load(f)
+        except (OSError, ValueError):
+            return None
         
-        ref_color_list = [(157, 188, 64)]
+        # mark as recently used for eviction
+        try:
+            os.utime(entry_file)
+        except OSError:
+            pass
         
-        color_diff_list = []
+        return row
+
+    def put(self, key, row):
+        """ store the traits of one image, written to a temporary file with a unique name first so that parallel workers never read partial entries,
+            a failed write only loses the cache entry, not the computed traits """
+        entry_file = self.cache_path + key + '.json'
+        tmp_file = None
         
-        for ref_color in ref_color_list:
+        try:
+            with tempfile.NamedTemporaryFile('w', dir = self.cache_path, suffix = '.tmp', delete = False) as f:
+                tmp_file = f.name
+                json.dump(row, f, default = lambda v: v.item() if hasattr(v, 'item') else str(v))
             
-            color_diff_index_value = color_diff_index(ref_color, rgb_colors)
-        
-            print('color_diff_index_value = {0}\n'.format(color_diff_index_value))
+            os.replace(tmp_file, entry_file)
         
-            color_diff_list.append(color_diff_index_value)
+        except OSError as e:
+            logger.warning("Failed to write result cache entry %s: %s", entry_file, e)
             
-        color_diff_list = np.hstack(color_diff_list)
-        
+            if tmp_file is not None:
+                try:
+                    os.remove(tmp_file)
+                except OSError:
+                    pass
 
+    def evict(self):
+        """ remove the least recently used entries when the cache holds more than max_entries """
+        entries = glob.glob(self.cache_path + '*.json')
         
-        # color differnce of each cluster center color compared with specific color tone
-        diff_skin = color_diff_list[0]
-        diff_foliage = color_diff_list[1]
-        diff_purple = color_diff_list[2]
+        if len(entries) <= self.max_entries:
+            return 0
         
+        entries = sorted(entries, key = lambda f: os.path.getmtime(f))
         
+        n_evicted = len(entries) - self.max_entries
         
-        #print(type(diff_skin))
+        for entry_file in entries[:n_evicted]:
+            try:
+                os.remove(entry_file)
+            except OSError:
+                pass
         
+        return n_evicted
 
-        
+    def clear(self):
+        """ invalidate all cached results """
+        for entry_file in glob.glob(self.cache_path + '*.json'):
+            os.remove(entry_file)
 
-        ###############################################
-        
-        #accquire medial axis of segmentation mask
-        #image_skeleton = medial_axis_image(thresh)
-        
-            
-        image_skeleton, skeleton = skeleton_bw(thresh)
-        '''
-        if args["debug"] == 1:
-            # save _skeleton result
-            result_file = (result_path + base_name + '_skeleton' + file_extension)
-            cv2.imwrite(result_file, img_as_ubyte(image_skeleton))
-        '''
-        
-        ############################################## leaf number computation
 
-        #min_distance_value = 3
-            
-        print("min_distance_value = {}\n".format(min_distance_value))
-        
-        #watershed based leaf area segmentaiton 
-        labels = watershed_seg(orig, thresh, min_distance_value)
-        
-        #n_leaves = int(len(np.unique(labels)))
-        
+# result cache of the current process, created by set_parameters
+result_cache = None
 
-        
-        #labels = watershed_seg_marker(orig, thresh, min_distance_value, img_marker)
-        
-        #individual_object_seg(orig, labels, result_path, base_name, file_extension)
 
-        #save watershed result label image
-        #Map component labels to hue val
-        label_hue = np.uint8(128*labels/np.max(labels))
-        #label_hue[labels == largest_label] = np.uint8(15)
-        blank_ch = 255*np.ones_like(label_hue)
-        labeled_img = cv2.merge([label_hue, blank_ch, blank_ch])
 
-        # cvt to BGR for display
-        labeled_img = cv2.cvtColor(labeled_img, cv2.COLOR_HSV2BGR)
-        
-        labeled_img[label_hue==0] = 0
+# set the pipeline parameters as module level variables, also used as initializer of worker processes
+def set_parameters(args_dict, worker_process = False):
+    
+    global args, min_size, min_distance_value, diagonal_line_length, num_clusters
+    global args_colorspace, args_channels, args_num_clusters, AI_model, merger_contour, result_cache, debug_artifacts, selected_traits
+    
+    args = args_dict
+    
+    setup_logging(args['verbose'])
+    
+    min_size = args['min_size']
 
+    min_distance_value = args['min_dist']
+    
+    diagonal_line_length = args['min_dist']
+    
+    num_clusters = args['num_clusters'] 
+    
+    args_colorspace = args['color_space']
+    args_channels = args['channels']
+    args_num_clusters = args['num_clusters']
+    
+    AI_model = args['AI']
+    
+    merger_contour = args['merger_contour']
+    
+    # debug result images to save
+    debug_artifacts = parse_debug_artifacts(args['debug_artifacts']) if args['debug'] == 1 else set()
+    
+    # traits to compute, only the pipeline stages they depend on are executed
+    selected_traits = parse_selection(args['traits'], list(TRAIT_OUTPUTS), 'traits')
+    
+    # result cache, the default cache folder is inside the output folder
+    if args['cache'] == 1:
+        result_cache = ResultCache(args['cache_path'] or os.path.join(args['output_path'] or args['path'], '.smart_cache'), args['cache_size'])
+    else:
+        result_cache = None
+    
+    # avoid oversubscription of cores, each worker process uses one OpenCV thread
+    if worker_process:
+        cv2.setNumThreads(1)
         
-        #############################################################################################
+        # load the AI model once when the worker process starts
+        if AI_model == 1:
+            warm_up_rembg_session()
+
+
+
+# draw pie chart of color distribution
+def save_pie_chart(result_img_path, counts_values, color_ratio, hex_colors):
+    
+    label_text = ["{}, {}".format(ratio, hex_color) for (ratio, hex_color) in zip(color_ratio, hex_colors)]
+    
+    cv2.imwrite(result_img_path, utils.draw_pie_chart(counts_values, label_text, hex_colors))
+
 
+# save the selected debug images of one image, the images are written by the background writer
+def save_debug_images(state, result_path, basename):
+    
+    image_save_path = result_path
+    
+    logger.debug("image_save_path: %s", image_save_path)
+
+    # save segmentation result, images of stages which were stopped early are skipped
+    if debug_artifact_enabled('mask'):
+        write_image_output(state.get('thresh'), image_save_path, basename, '_mask', 'mask')
+    
+    if debug_artifact_enabled('plant_region'):
+        write_image_output(state.get('roi_image'), image_save_path, basename, '_plant_region')
+    
+    if debug_artifact_enabled('excontour'):
+        write_image_output(state.get('trait_img'), image_save_path, basename, '_excontour')
+    
+    if debug_artifact_enabled('skeleton'):
+        write_image_output(state.get('image_skeleton'), image_save_path, basename, '_skeleton', 'mask')
+    
+    if debug_artifact_enabled('masked_roi'):
+        write_image_output(state.get('masked_image_ori'), image_save_path, basename, '_masked_roi')
+    
+    if debug_artifact_enabled('clustered'):
+        write_image_output(state.get('clustered_BGR'), image_save_path, basename, '_clustered')
 
-        #################################################################
-        n_leaves = int(len(np.unique(labels)))
+    #write_image_output(state.get('labeled_img'), image_save_path, basename, '_label')
+    
+    # pie chart is rendered by the background writer as well
+    if debug_artifact_enabled('pie') and state.get('counts') is not None:
         
-        #n_leaves = int(len((leaf_index_rec)))
+        result_img_path = image_save_path + basename + '_pie_color.png'
         
-        print('number of leaves = {0}'.format(n_leaves))
+        get_image_writer().submit(save_pie_chart, result_img_path, list(state['counts'].values()), list(state['color_ratio']), list(state['hex_colors']))
+    
+    
+    # generate Lab color space results
+    if debug_artifact_enabled('lab_channels') and state.get('clustered_BGR') is not None:
         
-        #save watershed result label image
-        #result_file = (result_path + base_name + '_leafspec' + file_extension)
-        #cv2.imwrite(result_file, label_trait)
+        (masked_rgb, L, A, B) = RGB2LAB(state['roi_image'], state['thresh'], state.get('roi_box'))
         
-        #save watershed result label image
-        #result_file = (track_result_path + base_name + '_trace' + file_extension)
-        #cv2.imwrite(result_file, track_trait)
+        write_image_output(L, image_save_path, basename, '_L', 'channel')
         
-
-            
-        #print("[INFO] {} n_leaves found\n".format(len(np.unique(labels)) - 1))
+        write_image_output(A, image_save_path, basename, '_A', 'channel')
+        
+        write_image_output(B, image_save_path, basename, '_B', 'channel')
         
-        #Path("/tmp/d/a.dat").name
+
+        (masked_rgb, L, A, B) = RGB2LAB(state['clustered_BGR'], state['thresh'], state.get('roi_box'))
         
-        #print("color_ratio = {}".format(color_ratio))
+        write_image_output(L, image_save_path, basename, '_clustered_L', 'channel')
         
-        #print("hex_colors = {}".format(hex_colors))
+        write_image_output(A, image_save_path, basename, '_clustered_A', 'channel')
         
-        #return image_file_name, QR_data, area, solidity, max_width, max_height, avg_curv, n_leaves, color_ratio, hex_colors, leaf_index_rec, area_rec, curv_rec, solidity_rec, major_axis_rec, minor_axis_rec, leaf_color_ratio_rec, leaf_color_value_rec
+        write_image_output(B, image_save_path, basename, '_clustered_B', 'channel')
+
+
+
+# compute traits of one image, the log records carry the image name
+def process_image(image):
+    
+    image_context.name = Path(image).name
+    
+    try:
+        return image_traits(image)
+    finally:
+        image_context.name = '-'
+
+
+
+# compute traits of one image and save the debug image results, return one row of the trait table, the number of leaves, the leaf records and the stage profile
+def image_traits(image):
+    
+    # skip unchanged images, the cached traits are reused and the existing result folder is kept
+    if result_cache is not None:
         
-        longest_axis = max(max_width, max_height)
+        cache_key = result_cache.key(image, args)
         
+        cached = result_cache.get(cache_key)
         
-        #cm_pixel_ratio = diagonal_line_length/avg_diagonal_length
+        if cached is not None:
+            
+            logger.info("Cached traits of image %s were reused...", image)
+            
+            # the same image content may be stored under another file name
+            cached['row'][0] = Path(image).name
+            
+            return cached['row'], cached['n_leaves'], cached['leaves'], None
+    
+    # check input image and generate output path
+    (image_file_name, basename, result_path) = generate_output_path(image)
         
-        cm_pixel_ratio = diameter_circle
+    # stage timing and memory records, None if profiling is disabled
+    profile = [] if args['profile'] == 1 else None
     
+    # main pipeline
+    state = extract_traits(image, result_path, requested_outputs(), profile)
     
-    #return image_file_name, b_value, area, solidity, longest_axis, diameter_circle, cm_pixel_ratio, n_leaves, hex_colors, color_ratio, color_diff_list
+    # traits which were not selected are left empty
+    def trait_value(trait, value):
+        return value if trait in selected_traits else None
     
+    row = [image_file_name, trait_value('leaf_area', state['area']), trait_value('solidity', state['solidity']), 
+            trait_value('max_width', state['max_width']), trait_value('max_height', state['max_height']), 
+            trait_value('compactness', state['compactness']), trait_value('longest_dimension', state['longest_dimension'])]
     
-    return area, solidity, max_width, max_height, compactness, longest_dimension, n_leaves, rgb_colors, hex_colors, color_ratio, color_diff_list, thresh, roi_image, trait_img, img_as_ubyte(image_skeleton), labeled_img, counts.values(), masked_image_ori, clustered_BGR, clustered_levels
+    for i in range(3):
+        row += [trait_value('color_hex', state['hex_colors'][i]), trait_value('color_ratio', state['color_ratio'][i]), trait_value('color_difference', state['color_diff_list'][i])]
     
-
-
-# Automatically generate result folder for each individual images
-def generate_output_path(input_image):
+    # number of watershed labels and the traits of each leaf, the leaf records are only computed for the Parquet leaf table
+    n_leaves = trait_value('leaves', state['n_leaves'])
     
-    if input_image is not None:
+    leaf_records = trait_value('leaves', state['leaf_records']) if args['parquet'] == 1 else None
+    
+    
+    if args["debug"] == 1:
         
-        # get file information
-        (file_path, filename, basename) = get_file_info(input_image)
+        if profile is None:
+            save_debug_images(state, result_path, basename)
+        else:
+            # time spent on queueing the debug images, including waiting for the background writer when its queue is full
+            profile_call(profile, 'debug_output', save_debug_images, state, result_path, basename)
+    
+    
+    if result_cache is not None:
+        result_cache.put(cache_key, {'row': row, 'n_leaves': n_leaves, 'leaves': leaf_records})
+    
+    return row, n_leaves, leaf_records, profile
+
+
 
-        print("Processing image {} ... \n".format(input_image))
+# process all images with a bounded pool of workers, yield (image_id, (row, n_leaves, leaf_records, profile)) as soon as each image was finished
+def batch_process(imgList, n_workers = 1, pool_type = 'process'):
+    
+    # serial processing in the current process
+    if n_workers < 2 or len(imgList) < 2:
         
-        # output folder path
-        if (args['output_path']):
-            output_path = args['output_path']
-        else:
-            mkpath = os.path.dirname(file_path) + '/' + basename
-            mkdir(mkpath)
-            output_path = mkpath + '/'
+        for image_id, image in enumerate(imgList):
+            
+            yield image_id, process_image(image)
         
-        print("Output path {} ... \n".format(output_path))
+        return
+    
+    
+    if pool_type == 'thread':
         
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers = n_workers)
     else:
-        print("Input image was None...\n")
+        # every worker process receives the same pipeline parameters as the main process
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers = n_workers, initializer = set_parameters, initargs = (args, True))
+    
+    logger.info("Using %d %s workers to perform parallel processing...", n_workers, pool_type)
+    
+    with executor:
         
-        sys.exit(1)
+        future_to_id = {executor.submit(process_image, image): image_id for image_id, image in enumerate(imgList)}
+        
+        for future in concurrent.futures.as_completed(future_to_id):
+            
+            yield future_to_id[future], future.result()
 
 
-    return filename, basename, output_path
 
 
 
+# column names of the trait table
+TRAIT_HEADER = ['filename', 'leaf_area', 'solidity', 'max_width', 'max_height', 'compactness', 'longest_dimension', 
+                'color_cluster_1_hex_value', 'color_cluster_1_ratio', 'color_cluster_1_difference', 
+                'color_cluster_2_hex_value', 'color_cluster_2_ratio', 'color_cluster_2_difference', 
+                'color_cluster_3_hex_value', 'color_cluster_3_ratio', 'color_cluster_3_difference']
 
-# save result files
-def write_image_output(imagearray, result_path, base_name, addition, ext):
+# columns stored as text in the Excel file, all other trait values are numbers
+TRAIT_TEXT_COLUMNS = {'filename', 'color_cluster_1_hex_value', 'color_cluster_1_ratio', 'color_cluster_2_hex_value', 'color_cluster_2_ratio', 
+                      'color_cluster_3_hex_value', 'color_cluster_3_ratio'}
 
-    # save segmentation result
-    result_file = (result_path + base_name + addition + ext)
-    
-    #print(result_file)
+
+# append only csv file of trait rows, each row is flushed to disk as soon as the image was finished,
+# so that a crashed run keeps all the finished results
+class TraitWriter:
     
-    cv2.imwrite(result_file, imagearray)
+    def __init__(self, trait_csv_file):
+        """ Create the csv file and write the header """
+        self.trait_csv_file = trait_csv_file
+        self.n_rows = 0
+        
+        self.f = open(trait_csv_file, 'w', newline = '')
+        self.writer = csv.writer(self.f)
+        
+        self.writer.writerow(TRAIT_HEADER)
+        self.f.flush()
+
+    def write_row(self, row):
+        """ append one trait row """
+        self.writer.writerow(row)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.n_rows += 1
+
+    def close(self):
+        self.f.close()
+
+
+
+# columnar trait output in Apache Parquet format, an image level table and a leaf level table linked by image_id,
+# rows are buffered and written in batches
+class ParquetTraitWriter:
     
-    # check saved file
-    if os.path.exists(result_file):
-        print("Result file was saved at {0}\n".format(result_file))
+    def __init__(self, output_path, batch_size = 64):
+        """ Create the image and leaf table files """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Parquet output requires pyarrow, install it with: pip3 install pyarrow")
+        
+        self.pa = pa
+        self.batch_size = batch_size
+        
+        self.image_schema = pa.schema([('image_id', pa.string()), 
+                                       ('leaf_area', pa.float64()), ('solidity', pa.float64()), ('max_width', pa.float64()), ('max_height', pa.float64()), 
+                                       ('compactness', pa.float64()), ('longest_dimension', pa.float64()), ('n_leaves', pa.int64()), 
+                                       ('hex_colors', pa.list_(pa.string())), ('color_ratio', pa.list_(pa.float64())), ('color_difference', pa.list_(pa.float64()))])
+        
+        self.leaf_schema = pa.schema([('image_id', pa.string()), ('leaf_index', pa.int64()), 
+                                      ('area', pa.float64()), ('curvature', pa.float64()), ('solidity', pa.float64()), 
+                                      ('major_axis', pa.float64()), ('minor_axis', pa.float64()), ('center_x', pa.float64()), ('center_y', pa.float64())])
+        
+        self.image_writer = pq.ParquetWriter(os.path.join(output_path, 'trait_image.parquet'), self.image_schema)
+        self.leaf_writer = pq.ParquetWriter(os.path.join(output_path, 'trait_leaf.parquet'), self.leaf_schema)
+        
+        self.image_rows = []
+        self.leaf_rows = []
 
-    else:
-        print("Result file writing failed!\n")
+    def write(self, row, n_leaves, leaf_records):
+        """ add the traits of one image, the trait row has the same layout as TRAIT_HEADER, traits which were not selected are None """
+        image_id = row[0]
+        
+        def optional(convert, values):
+            return None if values[0] is None else [convert(v) for v in values]
+        
+        (leaf_area, solidity, max_width, max_height, compactness, longest_dimension) = [None if v is None else float(v) for v in row[1:7]]
+        
+        self.image_rows.append({'image_id': image_id, 
+                                'leaf_area': leaf_area, 'solidity': solidity, 'max_width': max_width, 'max_height': max_height, 
+                                'compactness': compactness, 'longest_dimension': longest_dimension, 
+                                'n_leaves': n_leaves, 
+                                'hex_colors': optional(str, row[7::3]), 
+                                'color_ratio': optional(float, row[8::3]), 
+                                'color_difference': optional(float, row[9::3])})
+        
+        self.leaf_rows.extend(dict(record, image_id = image_id) for record in leaf_records or [])
+        
+        if len(self.image_rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ write the buffered rows as one row group """
+        if self.image_rows:
+            self.image_writer.write_table(self.pa.Table.from_pylist(self.image_rows, schema = self.image_schema))
+            self.image_rows = []
+        
+        if self.leaf_rows:
+            self.leaf_writer.write_table(self.pa.Table.from_pylist(self.leaf_rows, schema = self.leaf_schema))
+            self.leaf_rows = []
+
+    def close(self):
+        self.flush()
+        self.image_writer.close()
+        self.leaf_writer.close()
+
+
+
+# rate limited progress report of the batch, at most one message per interval
+class ProgressReporter:
     
+    def __init__(self, n_total, interval = 10.0):
+        """ Start the batch timer """
+        self.n_total = n_total
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last_report = self.start
 
+    def update(self, n_done):
+        """ report throughput and remaining time if the interval has passed or the batch was finished """
+        now = time.perf_counter()
+        
+        if (now - self.last_report < self.interval and n_done < self.n_total) or not logger.isEnabledFor(logging.INFO):
+            return
+        
+        self.last_report = now
+        
+        rate = n_done / max(now - self.start, 1e-9)
+        
+        eta = (self.n_total - n_done) / rate if rate > 0 else float('nan')
+        
+        logger.info("Progress %d/%d images, %.2f images/s, ETA %.0f s", n_done, self.n_total, rate, eta)
 
 
 
-# save results as excel file
-def write_excel_output(trait_file, result_list):
+# per image and per batch report of the stage profiles, saved as csv and json files next to the trait table
+class ProfileReport:
     
-    if os.path.isfile(trait_file):
-        # update values
-        #Open an xlsx for reading
-        wb = openpyxl.load_workbook(trait_file)
+    def __init__(self):
+        """ Start the batch timer """
+        self.records = []
+        self.n_cached = 0
+        self.start = time.perf_counter()
+
+    def add(self, image_file_name, profile):
+        """ add the stage records of one image, None for images whose traits were reused from the cache """
+        if profile is None:
+            self.n_cached += 1
+            return
+        
+        self.records.extend(dict(record, image = image_file_name) for record in profile)
+
+    def summary(self):
+        """ cost of each stage aggregated over the batch """
+        stages = OrderedDict()
+        
+        for record in self.records:
+            stages.setdefault(record['stage'], []).append(record)
+        
+        summary = OrderedDict()
+        
+        for stage, records in stages.items():
+            
+            wall = np.array([record['wall_s'] for record in records])
+            cpu = np.array([record['cpu_s'] for record in records])
+            
+            summary[stage] = {'count': len(records), 
+                              'wall_s_total': float(wall.sum()), 'wall_s_mean': float(wall.mean()), 'wall_s_max': float(wall.max()), 
+                              'cpu_s_total': float(cpu.sum()), 'cpu_s_mean': float(cpu.mean()), 
+                              'peak_rss_mb_max': max(record['peak_rss_mb'] for record in records)}
+        
+        return summary
 
-        #Get the current Active Sheet
-        sheet = wb.active
+    def write(self, output_path):
+        """ save trait_profile.csv with one row per image and stage, and trait_profile.json with the batch summary """
+        csv_file = os.path.join(output_path, 'trait_profile.csv')
+        json_file = os.path.join(output_path, 'trait_profile.json')
+        
+        with open(csv_file, 'w', newline = '') as f:
+            
+            writer = csv.DictWriter(f, fieldnames = ['image', 'stage', 'wall_s', 'cpu_s', 'peak_rss_mb'])
+            writer.writeheader()
+            writer.writerows(self.records)
+        
+        images = OrderedDict()
+        
+        for record in self.records:
+            
+            image = images.setdefault(record['image'], {'wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_mb': 0.0})
+            
+            image['wall_s'] += record['wall_s']
+            image['cpu_s'] += record['cpu_s']
+            image['peak_rss_mb'] = max(image['peak_rss_mb'], record['peak_rss_mb'])
         
-        sheet.delete_rows(2, sheet.max_row+1) # for entire sheet
+        report = OrderedDict([('n_images', len(images)), ('n_cached', self.n_cached), ('batch_wall_s', time.perf_counter() - self.start), 
+                              ('stages', self.summary()), ('images', images)])
         
-        #sheet_leaf = wb.create_sheet()
+        with open(json_file, 'w') as f:
+            json.dump(report, f, indent = 2)
         
-        #sheet_leaf.delete_rows(2, sheet_leaf.max_row+1) # for entire sheet
+        logger.info("Profile report was saved at %s", json_file)
 
 
-    else:
-        # Keep presets
-        wb = openpyxl.Workbook()
-        sheet = wb.active
-        
-        sheet_leaf = wb.create_sheet()
-
-        sheet.cell(row = 1, column = 1).value = 'filename'
-        sheet.cell(row = 1, column = 2).value = 'leaf_area'
-        sheet.cell(row = 1, column = 3).value = 'solidity'
-        sheet.cell(row = 1, column = 4).value = 'max_width'
-        sheet.cell(row = 1, column = 5).value = 'max_height'
-        sheet.cell(row = 1, column = 6).value = 'compactness'
-        sheet.cell(row = 1, column = 7).value = 'longest_dimension'
-        #sheet.cell(row = 1, column = 8).value = 'number_leaf'
-        sheet.cell(row = 1, column = 8).value = 'color_cluster_1_hex_value'
-        sheet.cell(row = 1, column = 9).value = 'color_cluster_1_ratio'
-        sheet.cell(row = 1, column = 10).value = 'color_cluster_1_difference'
-        sheet.cell(row = 1, column = 11).value = 'color_cluster_2_hex_value'
-        sheet.cell(row = 1, column = 12).value = 'color_cluster_2_ratio'
-        sheet.cell(row = 1, column = 13).value = 'color_cluster_2_difference'
-        sheet.cell(row = 1, column = 14).value = 'color_cluster_3_hex_value'
-        sheet.cell(row = 1, column = 15).value = 'color_cluster_3_ratio'
-        sheet.cell(row = 1, column = 16).value = 'color_cluster_3_difference'
-        
-        #return image_file_name, area, solidity, max_width, max_height, n_leaves, hex_colors, color_ratio, color_diff_list
-        
-    for row in result_list:
-        sheet.append(row)
-   
 
-    #save the csv file
+# convert the trait csv file into an Excel file, rows are sorted in the order of the filename list
+def write_excel_output(trait_file, trait_csv_file, filename_list):
+    import openpyxl
+    
+    order = {filename: index for index, filename in enumerate(filename_list)}
+    
+    with open(trait_csv_file, 'r', newline = '') as f:
+        
+        reader = csv.reader(f)
+        
+        header = next(reader)
+        
+        rows = sorted(reader, key = lambda row: order.get(row[0], len(order)))
+    
+    # write only mode streams rows into the file instead of keeping the whole workbook in memory
+    wb = openpyxl.Workbook(write_only = True)
+    sheet = wb.create_sheet()
+    
+    sheet.append(header)
+    
+    for row in rows:
+        
+        values = []
+        
+        for name, value in zip(header, row):
+            
+            # traits which were not selected are empty cells
+            if value == '':
+                value = None
+            
+            elif name not in TRAIT_TEXT_COLUMNS:
+                try:
+                    value = float(value)
+                except ValueError:
+                    pass
+            
+            values.append(value)
+        
+        sheet.append(values)
+
+    #save the excel file
     wb.save(trait_file)
 
 
 
 
 
-if __name__ == '__main__':
+# command line options of the pipeline, also used by the benchmark scripts to get the default parameters
+def build_arg_parser():
     
     ap = argparse.ArgumentParser()
     ap.add_argument("-p", "--path", dest = "path", type = str, required = True,    help = "path to image file")
@@ -2117,15 +3343,54 @@ if __name__ == '__main__':
     ap.add_argument('-md', '--min_dist', dest = "min_dist", type = int, required = False, default = 35,  help = 'distance threshold of watershed segmentation.')
     ap.add_argument("-da", "--diagonal", dest = "diagonal", type = float, required = False,  default = math.sqrt(2), help = "diagonal line length(cm) of indiviudal color checker module")
     ap.add_argument("-d", '--debug', dest = 'debug', type = int, required = False,  default = 1, help = "Whehter save image results or not, 1 = yes, 0 = no")
+    ap.add_argument("-dl", '--debug_artifacts', dest = 'debug_artifacts', type = str, required = False,  default = 'all', help = "comma separated debug images to save: all, " + ", ".join(DEBUG_ARTIFACTS))
+    ap.add_argument("-of", '--overlay_format', dest = 'overlay_format', type = str, required = False,  default = 'png', choices = ['png', 'jpg', 'webp'], help = "file format of color debug images, masks and Lab channels are always saved as png")
+    ap.add_argument("-q", '--quality', dest = 'quality', type = int, required = False,  default = 90, help = "jpg/webp quality of color debug images, 0 ~ 100")
+    ap.add_argument("-pc", '--png_compression', dest = 'png_compression', type = int, required = False,  default = 1, help = "png compression level of debug images, 0 ~ 9, higher is smaller and slower")
+    ap.add_argument("-bm", '--bilevel_mask', dest = 'bilevel_mask', type = int, required = False,  default = 1, help = "save binary masks as 1 bit png, 1 = yes, 0 = no")
+    ap.add_argument("-ps", '--preview_scale', dest = 'preview_scale', type = float, required = False,  default = 1.0, help = "scale factor of the saved debug images, < 1 saves downscaled previews")
+    ap.add_argument("-tr", '--traits', dest = 'traits', type = str, required = False,  default = 'all', help = "comma separated traits to compute, only the pipeline stages they depend on are executed: all, " + ", ".join(TRAIT_OUTPUTS))
+    ap.add_argument("-v", '--verbose', dest = 'verbose', type = int, required = False,  default = 1, help = "verbosity level, 0 = warnings and errors only, 1 = progress and summary, 2 = details of each pipeline stage")
+    ap.add_argument("-pi", '--progress_interval', dest = 'progress_interval', type = float, required = False,  default = 10.0, help = "minimum interval between progress reports in seconds")
+    ap.add_argument("-pf", '--profile', dest = 'profile', type = int, required = False,  default = 0, help = "Whether save wall time, CPU time and peak memory of each pipeline stage to trait_profile.json/csv or not, 1 = yes, 0 = no")
     ap.add_argument("-ai", '--AI', dest = 'AI', type = int, required = False,  default = 1, help = "Whehter use AI model or not, 1 = yes, 0 = no")
     ap.add_argument("-mc", '--merger_contour', dest = 'merger_contour', type = int, required = False,  default = 2, help = "merger_contour threshold, 1, 2, 3")
+    ap.add_argument("-se", '--seg_engine', dest = 'seg_engine', type = str, required = False,  default = 'auto', choices = ['auto', 'exact', 'sample', 'minibatch', 'histogram'], help = "K-means engine of plant segmentation: exact = fit all pixels, sample = fit a stratified pixel sample, minibatch = MiniBatchKMeans, histogram = exact 1-D clustering of single channel histogram, auto = histogram for single channel, otherwise sample")
+    ap.add_argument("-ss", '--sample_size', dest = 'sample_size', type = int, required = False,  default = 100000, help = "number of sampled pixels used to fit the cluster centers with the sample engine")
+    ap.add_argument("-sc", '--seg_scale', dest = 'seg_scale', type = float, required = False,  default = 1.0, help = "scale of the coarse to fine segmentation, e.g. 0.25 locates the plant on the downscaled image and classifies only the plant regions at full resolution, 1.0 = segment at full resolution; the mask may differ from the full resolution mask where the cluster centers fitted on the pixel sample differ or where a plant is not located at the coarse scale")
+    ap.add_argument("-sk", '--skeleton_engine', dest = 'skeleton_engine', type = str, required = False,  default = 'auto', choices = SKELETON_ENGINES, help = "skeleton engine: thin = skimage thin, guo_hall = the same thinning as numba kernel, zhang_suen = Zhang-Suen thinning, medial_axis = medial axis from the distance transform, auto = guo_hall if numba is installed, otherwise thin")
+    ap.add_argument("-roi", '--roi', dest = 'roi', type = int, required = False,  default = 1, help = "Whether process only the padded bounding box of the plant after segmentation or the full frame, 1 = ROI, 0 = full frame")
+    ap.add_argument("-seed", '--seed', dest = 'seed', type = int, required = False,  default = 0, help = "random seed of pixel sampling and K-means initialization")
+    ap.add_argument("-cache", '--cache', dest = 'cache', type = int, required = False,  default = 0, help = "Whether reuse cached traits of unchanged images or not, 1 = yes, 0 = no")
+    ap.add_argument("-cp", '--cache_path', dest = 'cache_path', type = str, required = False,  default = None, help = "result cache folder, default .smart_cache inside the output folder, or inside the input folder if no output folder is given")
+    ap.add_argument("-csz", '--cache_size', dest = 'cache_size', type = int, required = False,  default = 10000, help = "max number of cached image results, least recently used results are evicted")
+    ap.add_argument("-cc", '--clear_cache', dest = 'clear_cache', type = int, required = False,  default = 0, help = "Whether invalidate all cached results before processing, 1 = yes, 0 = no")
+    ap.add_argument("-pq", '--parquet', dest = 'parquet', type = int, required = False,  default = 0, help = "Whether also save image and leaf level trait tables in Parquet format or not, 1 = yes, 0 = no")
+    ap.add_argument("-wt", '--writer_threads', dest = 'writer_threads', type = int, required = False,  default = 2, help = "number of background threads writing the debug result images")
+    ap.add_argument("-wq", '--writer_queue', dest = 'writer_queue', type = int, required = False,  default = 16, help = "maximum number of debug result images waiting to be written, processing waits when the queue is full")
+    ap.add_argument("-w", '--workers', dest = 'workers', type = int, required = False,  default = 1, help = "number of parallel workers, 1 = serial processing")
+    ap.add_argument("-as", '--ai_size', dest = 'ai_size', type = int, required = False,  default = 0, help = "longer side in pixels of the downscaled image used by the AI model, 0 = full resolution")
+    ap.add_argument("-at", '--ai_threads', dest = 'ai_threads', type = int, required = False,  default = 0, help = "number of ONNX Runtime threads of the AI model in each worker, 0 = automatic")
+    ap.add_argument("-pt", '--pool_type', dest = 'pool_type', type = str, required = False,  default = 'process', choices = ['process', 'thread'], help = "type of worker pool for parallel processing, process or thread")
     
     #ap.add_argument("-cc", "--cue_color", dest = "cue_color", type = int, required = False,  default = 0, help="use color cue to detect plant object")
     #ap.add_argument("-cl", "--cue_loc", dest = "cue_loc", type = int, required = False,  default = 0, help="use location cue to detect plant object")
     #ap.add_argument("-ob", "--out_boundary", dest = "out_boundary", type = int, required = False,  default = 0, help="whether the plant object was out of the image boudary or not, 1 yes, 0 no, default 0")
     
+    return ap
+
+
+
+
+if __name__ == '__main__':
+    
+    ap = build_arg_parser()
+    
     args = vars(ap.parse_args())
     
+    # logging is set up before the first message, set_parameters sets the same level again
+    setup_logging(args['verbose'])
+    
 
     # input path
     input_path = args["path"]
@@ -2142,11 +3407,11 @@ if __name__ == '__main__':
         # check image file format 
         extension_type = check_file_type(input_path, None)
         
-        print("Number of input images: {}, Image format: {}\n".format(len(files), extension_type))
+        logger.info("Number of input images: %d, Image format: %s", len(files), extension_type)
     
     else:
         
-        print("Input folder was empty...\n")
+        logger.warning("Input folder was empty...")
         
         sys.exit(1)
     
@@ -2165,7 +3430,7 @@ if __name__ == '__main__':
     result_path = os.path.join(result_path, '')
 
     # printout result path
-    print("Output path: {}\n".format(result_path))
+    logger.info("Output path: %s", result_path)
     
     '''
   
@@ -2174,22 +3439,7 @@ if __name__ == '__main__':
     ########################################################################
     #parameters
     
-    min_size = args['min_size']
-
-    min_distance_value = args['min_dist']
-    
-    diagonal_line_length = args['min_dist']
-    
-    num_clusters = args['num_clusters'] 
-    
-    
-    args_colorspace = args['color_space']
-    args_channels = args['channels']
-    args_num_clusters = args['num_clusters']
-    
-    AI_model = args['AI']
-    
-    merger_contour = args['merger_contour']
+    set_parameters(args)
     
 
     #accquire image file list
@@ -2200,88 +3450,75 @@ if __name__ == '__main__':
     
     n_images = len(imgList)
     
-    result_list = []
+    # number of workers, no more than the number of images
+    n_workers = max(1, min(args['workers'], n_images))
     
-
-    # loop execute all images in input file path
-    for image_id, image in enumerate(imgList):
-        
-        # check input image and generate output path
-        (image_file_name, basename, result_path) = generate_output_path(image)
-            
-        # main pipeline
-        (area, solidity, max_width, max_height, compactness, longest_dimension, n_leaves, rgb_colors, hex_colors, color_ratio, color_diff_list, thresh, roi_image, trait_img, image_skeleton, labeled_img, counts_values, masked_image_ori, clustered_BGR, clustered_levels) = extract_traits(image)
-        
-        
-        result_list.append([image_file_name, area, solidity, max_width, max_height, compactness, longest_dimension,  
-                            hex_colors[0], color_ratio[0], color_diff_list[0], 
-                            hex_colors[1], color_ratio[1], color_diff_list[1], 
-                            hex_colors[2], color_ratio[2], color_diff_list[2]])
+    # share the cores among the AI model sessions of the worker processes
+    if args['ai_threads'] == 0 and n_workers > 1 and args['pool_type'] == 'process':
+        args['ai_threads'] = max(1, (os.cpu_count() or 1) // n_workers)
+    
+    # load the AI model once before processing, worker processes load their own session
+    if AI_model == 1 and (n_workers < 2 or args['pool_type'] == 'thread'):
+        warm_up_rembg_session()
+    
+    if result_cache is not None and args['clear_cache'] == 1:
         
+        logger.info("Clearing result cache...")
         
-        if args["debug"] == 1:
-            '''
-            mkpath = os.path.dirname(result_path) + '/' + basename + '/'
-            mkdir(mkpath)
-            image_save_path = os.path.join(mkpath, '')
-            '''
-            
-            file_extension = '.png'
-            
-            
-            image_save_path = result_path
-            
-            print("image_save_path: {}\n".format(image_save_path))
-
-            # save segmentation result
-            write_image_output(thresh, image_save_path, basename, '_mask', file_extension)
-            
-            write_image_output(roi_image, image_save_path, basename, '_plant_region', file_extension)
-            
-            write_image_output(trait_img, image_save_path, basename, '_excontour', file_extension)
-            
-            write_image_output(img_as_ubyte(image_skeleton), image_save_path, basename, '_skeleton', file_extension)
-
-            write_image_output(masked_image_ori, image_save_path, basename, '_masked_roi', file_extension)
-            
-            write_image_output(clustered_BGR, image_save_path, basename, '_clustered', file_extension)
-
-            #write_image_output(labeled_img, image_save_path, basename, '_label', file_extension)
-            
-            fig_pie = plt.figure(figsize = (8, 6))
-            
-            label_text = list(zip(color_ratio, hex_colors))
-            
-            #print(type(color_ratio))
-            
-            fig_pie = plt.pie(counts_values, labels = label_text, colors = hex_colors)
-            result_img_path = image_save_path + basename + '_pie_color.png'
-            plt.savefig(result_img_path)
-            
-            
-            # generate Lab color space results
-            (masked_rgb, L, A, B) = RGB2LAB(roi_image, thresh)
-            
-            write_image_output(L, image_save_path, basename, '_L', file_extension)
-            
-            write_image_output(A, image_save_path, basename, '_A', file_extension)
+        result_cache.clear()
+    
+    
+    trait_file = os.path.join(input_path, 'trait.xlsx')
+    trait_csv_file = os.path.join(input_path, 'trait.csv')
+    
+    # trait rows are appended to the csv file as soon as each image was finished
+    trait_writer = TraitWriter(trait_csv_file)
+    
+    # image and leaf level tables in Parquet format
+    parquet_writer = ParquetTraitWriter(input_path) if args['parquet'] == 1 else None
+    
+    # cost of the pipeline stages
+    profile_report = ProfileReport() if args['profile'] == 1 else None
+    
+    progress = ProgressReporter(n_images, args['progress_interval'])
+    
+    try:
+        # loop execute all images in input file path, results are streamed back in the order of completion
+        for image_id, (row, n_leaves, leaf_records, profile) in batch_process(imgList, n_workers, args['pool_type']):
             
-            write_image_output(B, image_save_path, basename, '_B', file_extension)
+            trait_writer.write_row(row)
             
-
-            (masked_rgb, L, A, B) = RGB2LAB(clustered_BGR, thresh)
+            if profile_report is not None:
+                profile_report.add(row[0], profile)
             
-            write_image_output(L, image_save_path, basename, '_clustered_L', file_extension)
+            if parquet_writer is not None:
+                parquet_writer.write(row, n_leaves, leaf_records)
             
-            write_image_output(A, image_save_path, basename, '_clustered_A', file_extension)
+            logger.debug("%s finished...", row[0])
             
-            write_image_output(B, image_save_path, basename, '_clustered_B', file_extension)
+            progress.update(trait_writer.n_rows)
+    
+    finally:
+        trait_writer.close()
+        
+        # debug result images queued in the main process
+        close_image_writer()
+        
+        if parquet_writer is not None:
+            parquet_writer.close()
+    
+    if profile_report is not None:
+        profile_report.write(input_path)
+    
+    # keep the cache within its size limit
+    if result_cache is not None:
+        result_cache.evict()
             
 
     #########################################################################
     #trait_file = (os.path.dirname(os.path.abspath(file_path)) + '/' + 'trait.xlsx')
     
-    print("Summary: {0} plant images were processed...\n".format(n_images))
+    logger.info("Summary: %d plant images were processed...", n_images)
     
     #output in command window in a sum table
  
@@ -2296,17 +3533,17 @@ if __name__ == '__main__':
 
     
     ########################################################################################
-    trait_file = (input_path + 'trait.xlsx')
     #trait_file = (result_path + 'trait.xlsx')
 
-    write_excel_output(trait_file, result_list)
+    # keep the same order as the input image list
+    write_excel_output(trait_file, trait_csv_file, [Path(image).name for image in imgList])
 
     
     if os.path.exists(trait_file):
         
-        print("Result file was saved at {}\n".format(trait_file))
+        logger.info("Result file was saved at %s", trait_file)
     else:
-        print("Error in saving Result file\n")
+        logger.error("Error in saving Result file")
     
     '''
     #####################################################################################
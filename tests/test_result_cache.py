@@ -0,0 +1,76 @@
+'''
+Name: test_result_cache.py
+
+Version: 1.0
+
+Summary: Check that parallel writes of the same entry of the result cache of smart_release.py do not fail
+    and that a failed cache write does not raise
+
+USAGE:
+
+    python3 -m pytest tests/test_result_cache.py
+
+'''
+
+import os
+import sys
+import glob
+import threading
+
+
+# root folder of the repository
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, REPO_PATH)
+
+import smart_release as sr
+
+
+# two threads write the same key at the same time, e.g. two image files with identical content in one batch
+def test_put_same_key_from_two_threads(tmp_path):
+
+    cache = sr.ResultCache(str(tmp_path))
+
+    rows = [{'row': ['a.png', 1.0], 'n_leaves': 3, 'leaves': None}, {'row': ['b.png', 1.0], 'n_leaves': 3, 'leaves': None}]
+
+    # the barrier is broken if one writer fails, so that the other writer does not wait forever
+    barrier = threading.Barrier(2, timeout = 10)
+
+    errors = []
+
+    def writer(row):
+        try:
+            for i in range(200):
+                barrier.wait()
+                cache.put('same_key', row)
+        except threading.BrokenBarrierError:
+            pass
+        except Exception as e:
+            errors.append(e)
+            barrier.abort()
+
+    threads = [threading.Thread(target = writer, args = (row,)) for row in rows]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+
+    assert cache.get('same_key') in rows
+
+    assert glob.glob(os.path.join(str(tmp_path), '*.tmp')) == []
+
+
+# a cache folder which can not be written only loses the cache entry
+def test_put_failure_is_not_raised(tmp_path):
+
+    cache = sr.ResultCache(str(tmp_path / 'cache'))
+
+    os.rmdir(str(tmp_path / 'cache'))
+
+    cache.put('key', {'row': ['a.png'], 'n_leaves': 0, 'leaves': None})
+
+    assert cache.get('key') is None
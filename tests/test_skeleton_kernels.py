@@ -0,0 +1,77 @@
+'''
+Name: test_skeleton_kernels.py
+
+Version: 1.0
+
+Summary: Check that the Guo-Hall numba kernel of skeleton_kernels.py gives the same skeleton as skimage.morphology.thin
+    on the sample masks and on random masks, skipped if numba is not installed
+
+USAGE:
+
+    python3 -m pytest tests/test_skeleton_kernels.py
+
+'''
+
+import os
+import sys
+import glob
+
+import numpy as np
+import cv2
+import pytest
+
+from scipy import ndimage
+from skimage.morphology import thin
+
+
+# root folder of the repository
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, REPO_PATH)
+
+pytest.importorskip('numba')
+
+import skeleton_kernels
+
+
+# sample masks are downscaled, thin needs about a minute on the full resolution mask
+MASK_SCALE = 0.25
+
+MASK_FILES = sorted(glob.glob(os.path.join(REPO_PATH, 'sample_test', '**', '*_mask.png'), recursive = True))
+
+
+# random blobs: smoothed noise thresholded at a random level, the foreground also touches the image border
+def random_mask(seed, shape):
+
+    rng = np.random.default_rng(seed)
+
+    noise = ndimage.gaussian_filter(rng.random(shape), sigma = rng.uniform(1.0, 4.0))
+
+    return noise > np.quantile(noise, rng.uniform(0.3, 0.7))
+
+
+
+@pytest.mark.parametrize('mask_file', MASK_FILES, ids = [os.path.basename(f) for f in MASK_FILES])
+def test_guo_hall_sample_masks(mask_file):
+
+    mask = cv2.imread(mask_file, cv2.IMREAD_GRAYSCALE)
+
+    mask = cv2.resize(mask, None, fx = MASK_SCALE, fy = MASK_SCALE, interpolation = cv2.INTER_NEAREST) > 127
+
+    assert np.array_equal(skeleton_kernels.guo_hall_thinning(mask), thin(mask))
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_guo_hall_random_masks(seed):
+
+    mask = random_mask(seed, (64 + 16*seed, 96))
+
+    assert np.array_equal(skeleton_kernels.guo_hall_thinning(mask), thin(mask))
+
+
+# single pixels, lines and a filled image are thinned as by thin
+@pytest.mark.parametrize('mask', [np.zeros((5, 5), dtype = bool), np.ones((7, 9), dtype = bool), np.eye(6, dtype = bool), np.pad(np.ones((1, 8), dtype = bool), 2)],
+                         ids = ['empty', 'filled', 'diagonal', 'line'])
+def test_guo_hall_simple_masks(mask):
+
+    assert np.array_equal(skeleton_kernels.guo_hall_thinning(mask), thin(mask))